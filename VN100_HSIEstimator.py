@@ -1,27 +1,1204 @@
+import argparse
+import ast
+import fcntl
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import selectors
+import struct
+import termios
 import threading
 import time
 import numpy as np
 import serial
+from concurrent.futures import Future, TimeoutError as ResponseTimeout
 from warnings import warn 
 
-class HSIEstimator():
+# VNERR codes, as listed in the vn100 user manual
+VN_ERROR_CODES = {
+    1: 'Hard Fault',
+    2: 'Serial Buffer Overflow',
+    3: 'Invalid Checksum',
+    4: 'Invalid Command',
+    5: 'Not Enough Parameters',
+    6: 'Too Many Parameters',
+    7: 'Invalid Parameter',
+    8: 'Invalid Register',
+    9: 'Unauthorized Access',
+    10: 'Watchdog Reset',
+    11: 'Output Buffer Overflow',
+    12: 'Insufficient Baud Rate',
+    255: 'Error Buffer Overflow',
+}
+
+# baud rates register 5 accepts
+VN_BAUD_RATES = (9600, 19200, 38400, 57600, 115200, 128000, 230400, 460800, 921600)
+
+# these codes are replies to a command we sent, the rest can show up at any time
+VN_COMMAND_ERRORS = (3, 4, 5, 6, 7, 8, 9, 12)
+
+# linux struct serial_icounter_struct: cts, dsr, rng, dcd, rx, tx, frame, overrun, parity, brk, buf_overrun, reserved[9]
+_ICOUNT = struct.Struct('<20i')
+# the error counters out of it, as (name, index)
+TTY_ERROR_COUNTERS = (('frame', 6), ('overrun', 7), ('parity', 8), ('break', 9), ('buf_overrun', 10))
+
+# driver side error counts for a serial fd, or None if the driver doesn't keep them(e.g. a pty)
+# overrun is the uart fifo overflowing before the driver emptied it, buf_overrun the tty buffer filling up
+def tty_error_counts(fd: int):
+    try:
+        counts = _ICOUNT.unpack(fcntl.ioctl(fd, termios.TIOCGICOUNT, bytes(_ICOUNT.size)))
+    except OSError:
+        return None
+    return {name: counts[index] for name, index in TTY_ERROR_COUNTERS}
+
+# struct formats for xor-ing payloads 8 bytes at a time, cached by word count
+_XOR_WORDS = {}
+
+# 8-bit checksum used by the ascii protocol, the xor of every byte between $ and *
+def vn_xor8(data) -> int:
+    n_words = len(data) >> 3
+    words = _XOR_WORDS.get(n_words)
+    if words is None:
+        words = _XOR_WORDS[n_words] = struct.Struct(f'<{n_words}Q')
+    x = int.from_bytes(data[n_words << 3:], 'little')
+    for word in words.unpack_from(data):
+        x ^= word
+    # fold the 64 bit word down to a single byte
+    x ^= x >> 32
+    x ^= x >> 16
+    x ^= x >> 8
+    return x & 0xFF
+
+# lookup table for the CRC16-CCITT used by the binary protocol and the 4 digit ascii checksum
+def _crc16_table() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+_CRC16_TABLE = _crc16_table()
+
+def vn_crc16(data, crc: int = 0) -> int:
+    table = _CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+# checks the body of a received line against its *XX (8-bit) or *XXXX (16-bit) suffix
+def vn_checksum_ok(body, suffix) -> bool:
+    try:
+        expected = int(suffix, 16)
+    except ValueError:
+        return False
+    if len(suffix) == 2:
+        return vn_xor8(body) == expected
+    if len(suffix) == 4:
+        return vn_crc16(body) == expected
+    return False
+
+# validates a batch of recorded lines at once, returning a boolean mask of the good ones
+# the xor is done by numpy over a zero padded matrix of the line bodies
+def validate_lines(lines: list) -> np.ndarray:
+    bodies = []
+    expected = np.full(len(lines), -1, dtype=np.int16)
+    valid = np.zeros(len(lines), dtype=bool)
+    crc_lines = []
+    for i, line in enumerate(lines):
+        line = line.strip()
+        star = line.rfind(b'*')
+        if not line.startswith(b'$') or star < 0:
+            bodies.append(b'')
+            continue
+        body, suffix = line[1:star], line[star + 1:]
+        if len(suffix) == 4:
+            # crc16 can't be vectorized this way, check those one by one
+            crc_lines.append(i)
+            valid[i] = vn_checksum_ok(body, suffix)
+            bodies.append(b'')
+            continue
+        try:
+            if len(suffix) == 2:
+                expected[i] = int(suffix, 16)
+        except ValueError:
+            pass
+        bodies.append(body)
+    if not lines:
+        return valid
+
+    width = max(len(b) for b in bodies) or 1
+    padded = b''.join(b.ljust(width, b'\0') for b in bodies)
+    matrix = np.frombuffer(padded, dtype=np.uint8).reshape(len(lines), width)
+    xor_valid = np.bitwise_xor.reduce(matrix, axis=1) == expected
+    xor_valid[crc_lines] = False
+    return valid | xor_valid
+
+# Binary output groups, in bit order of the group byte. Each field is (name, numpy type, count),
+# in bit order of that group's 16-bit field mask. Groups the vn100 doesn't have are None
+BINARY_SYNC = 0xFA
+BINARY_GROUPS = [
+    ('common', [
+        ('time_startup', '<u8', 1),
+        ('time_gps', '<u8', 1),
+        ('time_sync_in', '<u8', 1),
+        ('ypr', '<f4', 3),
+        ('quaternion', '<f4', 4),
+        ('angular_rate', '<f4', 3),
+        ('position', '<f8', 3),
+        ('velocity', '<f4', 3),
+        ('accel', '<f4', 3),
+        ('imu', '<f4', 6),
+        ('mag_pres', '<f4', 5),
+        ('delta_theta_vel', '<f4', 7),
+        ('ins_status', '<u2', 1),
+        ('sync_in_cnt', '<u4', 1),
+        ('time_gps_pps', '<u8', 1),
+    ]),
+    ('time', [
+        ('time_startup', '<u8', 1),
+        ('time_gps', '<u8', 1),
+        ('gps_tow', '<u8', 1),
+        ('gps_week', '<u2', 1),
+        ('time_sync_in', '<u8', 1),
+        ('time_gps_pps', '<u8', 1),
+        ('time_utc', 'u1', 8),
+        ('sync_in_cnt', '<u4', 1),
+        ('sync_out_cnt', '<u4', 1),
+        ('time_status', 'u1', 1),
+    ]),
+    ('imu', [
+        ('imu_status', '<u2', 1),
+        ('uncomp_mag', '<f4', 3),
+        ('uncomp_accel', '<f4', 3),
+        ('uncomp_gyro', '<f4', 3),
+        ('temp', '<f4', 1),
+        ('pres', '<f4', 1),
+        ('delta_theta', '<f4', 4),
+        ('delta_vel', '<f4', 3),
+        ('mag', '<f4', 3),
+        ('accel', '<f4', 3),
+        ('angular_rate', '<f4', 3),
+        ('sens_sat', '<u2', 1),
+    ]),
+    None, # gps, vn-200/300 only
+    ('attitude', [
+        ('vpe_status', '<u2', 1),
+        ('ypr', '<f4', 3),
+        ('quaternion', '<f4', 4),
+        ('dcm', '<f4', 9),
+        ('mag_ned', '<f4', 3),
+        ('accel_ned', '<f4', 3),
+        ('linear_accel_body', '<f4', 3),
+        ('linear_accel_ned', '<f4', 3),
+        ('ypr_u', '<f4', 3),
+    ]),
+    None, # ins, vn-200/300 only
+    None, # gps2, vn-300 only
+]
+
+# number of group field masks that follow a group byte, None if it names a group we can't size
+_BINARY_GROUP_COUNTS = [
+    None if groups == 0 or groups & 0x80 or any(
+        groups & (1 << bit) and BINARY_GROUPS[bit] is None for bit in range(7))
+    else bin(groups).count('1')
+    for groups in range(256)
+]
+
+# header bytes (sync, groups, field masks) -> structured dtype of the payload
+_BINARY_LAYOUTS = {}
+
+# works out the packed numpy dtype for the payload that follows a binary header
+# fields are named group_field, e.g. 'imu_uncomp_mag'. Returns None for headers we can't decode
+def binary_layout(header: bytes):
+    if header in _BINARY_LAYOUTS:
+        return _BINARY_LAYOUTS[header]
+    layout = None
+    groups = header[1]
+    if _BINARY_GROUP_COUNTS[groups] is not None:
+        fields = []
+        masks = iter(struct.unpack_from(f'<{_BINARY_GROUP_COUNTS[groups]}H', header, 2))
+        for bit in range(7):
+            if not groups & (1 << bit):
+                continue
+            group_name, group_fields = BINARY_GROUPS[bit]
+            mask = next(masks)
+            if mask >> len(group_fields):
+                # field bits this table doesn't know the size of
+                fields = None
+                break
+            for field_bit, (name, fmt, count) in enumerate(group_fields):
+                if mask & (1 << field_bit):
+                    field = f'{group_name}_{name}'
+                    fields.append((field, fmt) if count == 1 else (field, fmt, (count,)))
+        if fields:
+            layout = np.dtype(fields)
+    _BINARY_LAYOUTS[header] = layout
+    return layout
+
+# decodes many payloads that share a header with a single np.frombuffer call
+def decode_binary_packets(header: bytes, payloads: list) -> np.ndarray:
+    layout = binary_layout(header)
+    if layout is None:
+        raise ValueError(f"Unknown binary output layout for header {header.hex()}")
+    return np.frombuffer(b''.join(payloads), dtype=layout)
+
+# ASCII async outputs we decode, as (column name, count) in the order they appear in the message
+ASCII_OUTPUTS = {
+    b'VNYMR': [('ypr', 3), ('mag', 3), ('accel', 3), ('gyro', 3)],
+    b'VNQMR': [('quaternion', 4), ('mag', 3), ('accel', 3), ('gyro', 3)],
+    b'VNMAR': [('mag', 3), ('accel', 3), ('gyro', 3)],
+    b'VNIMU': [('uncomp_mag', 3), ('uncomp_accel', 3), ('uncomp_gyro', 3), ('temp', 1), ('pres', 1)],
+    b'VNMAG': [('mag', 3)],
+}
+
+# register 6 values that turn on each of the outputs above
+ASCII_OUTPUT_TYPES = {
+    b'VNQMR': 8,
+    b'VNMAG': 10,
+    b'VNMAR': 13,
+    b'VNYMR': 14,
+    b'VNIMU': 19,
+}
+
+def ascii_layout(msg_type: bytes) -> np.dtype:
+    return np.dtype([(name, '<f8') if count == 1 else (name, '<f8', (count,))
+                     for name, count in ASCII_OUTPUTS[msg_type]])
+
+# Least squares ellipsoid fit of raw magnetometer samples(an N x 3 array)
+# Returns the hard/soft iron compensation in the register 47 layout, where the corrected
+# measurement is C * (raw - B). C keeps the volume(det(C) = 1), so the field strength is kept too
+def fit_ellipsoid(mag: np.ndarray) -> dict:
+    mag = np.asarray(mag, dtype=np.float64)
+    if len(mag) < 9:
+        raise ValueError(f"Need at least 9 samples for an ellipsoid fit, got {len(mag)}")
+    x, y, z = mag[:, 0], mag[:, 1], mag[:, 2]
+    # general quadric a*x^2 + b*y^2 + c*z^2 + 2d*xy + 2e*xz + 2f*yz + 2g*x + 2h*y + 2i*z = 1
+    design = np.column_stack((x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z))
+    # solving the 9x9 normal equations keeps this fast for hundreds of thousands of samples
+    v = np.linalg.solve(design.T @ design, design.sum(axis=0))
+    return ellipsoid_to_hsi(v)
+
+# turns the 9 quadric parameters from the fit into C and B
+def ellipsoid_to_hsi(v: np.ndarray) -> dict:
+    quadric = np.array([[v[0], v[3], v[4]],
+                        [v[3], v[1], v[5]],
+                        [v[4], v[5], v[2]]])
+    center = -np.linalg.solve(quadric, v[6:9])
+    shape = quadric / (1 + center @ quadric @ center)
+    w, vecs = np.linalg.eigh(shape)
+    if np.any(w <= 0):
+        raise ValueError("Samples don't fit an ellipsoid, rotate through more orientations")
+    # C is the square root of the shape matrix, scaled to keep the volume
+    c_matrix = (vecs * np.sqrt(w)) @ vecs.T / np.prod(w) ** (1 / 6)
+    return {"C": c_matrix.ravel().tolist(),
+            "B": center.tolist()}
+
+# Recursive least squares version of fit_ellipsoid, updated one magnetometer sample at a time
+# Every update is a fixed amount of 9x9 work and nothing is kept but the parameters and their covariance,
+# so a live estimate is always ready no matter how long the calibration runs.
+# forgetting < 1 slowly discounts old samples
+class RecursiveHSIEstimator():
+    def __init__(self, forgetting: float = 1.0, initial_covariance: float = 1e4):
+        self.forgetting = forgetting
+        self.theta = np.zeros(9)
+        self.covariance = np.eye(9) * initial_covariance
+        self.count = 0
+
+    def update(self, mag):
+        x, y, z = float(mag[0]), float(mag[1]), float(mag[2])
+        phi = np.array((x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z))
+        p_phi = self.covariance @ phi
+        gain = p_phi / (self.forgetting + phi @ p_phi)
+        # swap in new arrays rather than editing in place, so estimate() never sees half an update
+        self.theta = self.theta + gain * (1.0 - phi @ self.theta)
+        self.covariance = (self.covariance - np.outer(gain, p_phi)) / self.forgetting
+        self.count += 1
+
+    # C and B in the register 47 layout, raises ValueError until the samples describe an ellipsoid
+    def estimate(self) -> dict:
+        return ellipsoid_to_hsi(self.theta)
+
+# Tracks which directions the (compensated) magnetometer has pointed in during the rotation phase
+# The unit sphere is cut into an equal-area grid: equal steps in z are equal areas, split into equal
+# azimuth sectors. Each sample is one bin lookup, so coverage is always up to date
+class CoverageTracker():
+    def __init__(self, bands: int = 4, sectors: int = 8):
+        self.bands = bands
+        self.sectors = sectors
+        self.counts = np.zeros(bands * sectors, dtype=np.int64)
+        self.bins_hit = 0
+        self.samples = 0
+        # compensation applied before binning, so hard iron doesn't skew the directions
+        self.c_matrix = np.eye(3)
+        self.b_vector = np.zeros(3)
+
+    def set_compensation(self, c_matrix, b_vector):
+        self.c_matrix = np.asarray(c_matrix, dtype=float).reshape(3, 3)
+        self.b_vector = np.asarray(b_vector, dtype=float)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.bins_hit = 0
+        self.samples = 0
+
+    def update(self, mag):
+        x, y, z = self.c_matrix @ (np.asarray(mag, dtype=float) - self.b_vector)
+        norm = math.sqrt(x * x + y * y + z * z)
+        if norm == 0:
+            return
+        band = min(int((z / norm + 1) * 0.5 * self.bands), self.bands - 1)
+        sector = int((math.atan2(y, x) + math.pi) / (2 * math.pi) * self.sectors) % self.sectors
+        index = band * self.sectors + sector
+        if self.counts[index] == 0:
+            self.bins_hit += 1
+        self.counts[index] += 1
+        self.samples += 1
+
+    # vectorized update for a block of samples, e.g. re-binning the buffer after the compensation changed
+    def update_many(self, mags: np.ndarray):
+        vectors = (np.asarray(mags, dtype=float) - self.b_vector) @ self.c_matrix.T
+        norms = np.linalg.norm(vectors, axis=1)
+        vectors = vectors[norms > 0] / norms[norms > 0, None]
+        bands = np.minimum(((vectors[:, 2] + 1) * 0.5 * self.bands).astype(int), self.bands - 1)
+        sectors = ((np.arctan2(vectors[:, 1], vectors[:, 0]) + np.pi) / (2 * np.pi) * self.sectors).astype(int) % self.sectors
+        np.add.at(self.counts, bands * self.sectors + sectors, 1)
+        self.bins_hit = int(np.count_nonzero(self.counts))
+        self.samples += len(vectors)
+
+    # fraction of the sphere visited, or None before any samples came in
+    @property
+    def coverage(self):
+        if self.samples == 0:
+            return None
+        return self.bins_hit / len(self.counts)
+
+# Online estimate of the vn100's startup clock against host monotonic time, from binary packets carrying time_startup
+# A host timestamp is the true arrival time plus serial, driver and scheduling delay, which is never negative,
+# so host - sensor is bounded below by the true offset. The lowest offset in each window of sensor time is kept
+# and a line fitted under the recent minima(the lower envelope) gives the offset and drift
+class SensorClock():
+    def __init__(self, window_ns: int = 1_000_000_000, windows: int = 60):
+        self.window_ns = window_ns
+        self.windows = windows
+        self.reset()
+
+    def reset(self):
+        # (sensor ns, offset ns) with the lowest offset of each finished window
+        self.minima = []
+        self.window_start = None
+        self.window_min = None
+        # host = sensor + offset_ns + drift * (sensor - reference_ns)
+        self.offset_ns = None
+        self.reference_ns = 0
+        self.drift = 0.0
+        self.count = 0
+
+    def update(self, sensor_ns: int, host_ns: int):
+        offset = host_ns - sensor_ns
+        if self.window_start is not None and sensor_ns < self.window_start:
+            # the sensor clock went backwards, it was reset
+            self.reset()
+        if self.window_start is None or sensor_ns - self.window_start >= self.window_ns:
+            if self.window_min is not None:
+                self.minima.append(self.window_min)
+                del self.minima[:-self.windows]
+                self.fit()
+            self.window_start = sensor_ns
+            self.window_min = (sensor_ns, offset)
+            if self.offset_ns is None:
+                self.offset_ns, self.reference_ns = offset, sensor_ns
+        elif offset < self.window_min[1]:
+            self.window_min = (sensor_ns, offset)
+            if len(self.minima) == 0:
+                # nothing to fit yet, the lowest offset so far is the best guess
+                self.offset_ns, self.reference_ns = offset, sensor_ns
+        self.count += 1
+
+    def fit(self):
+        points = np.array(self.minima, dtype=np.float64)
+        reference = points[-1, 0]
+        t = points[:, 0] - reference
+        if len(points) < 2 or np.ptp(t) == 0:
+            drift, offset = 0.0, points[:, 1].min()
+        else:
+            drift, offset = np.polyfit(t, points[:, 1], 1)
+            # move the line down until no minimum sits below it
+            offset += np.min(points[:, 1] - (offset + drift * t))
+        self.offset_ns, self.reference_ns, self.drift = offset, reference, drift
+
+    # host monotonic ns for sensor startup times, scalar or array. None until a sample has come in
+    def to_host_ns(self, sensor_ns):
+        if self.offset_ns is None:
+            return None
+        sensor_ns = np.asarray(sensor_ns, dtype=np.float64)
+        return np.rint(sensor_ns + self.offset_ns + self.drift * (sensor_ns - self.reference_ns)).astype(np.int64)
+
+    # sensor clock rate error in parts per million, positive when the sensor runs slow against the host
+    @property
+    def drift_ppm(self) -> float:
+        return self.drift * 1e6
+
+# binary fields holding the sensor's startup time, either can drive the SensorClock
+STARTUP_TIME_FIELDS = ('common_time_startup', 'time_time_startup')
+
+# Preallocated ring of decoded samples, stored as a numpy structured array
+# Appending never allocates, and latest() returns the newest samples in order
+# host_ns runs alongside it with the host monotonic time each sample's frame was read at
+class SampleBuffer():
+    def __init__(self, dtype, capacity: int = 65536):
+        self.data = np.zeros(capacity, dtype=dtype)
+        # the same memory as rows of raw bytes, so binary payloads can be copied straight in
+        self.raw = self.data.view(np.uint8).reshape(capacity, self.data.dtype.itemsize)
+        # and as rows of floats when every column is a float64, so parsed text can be assigned in one go
+        self.values = None
+        if all(self.data.dtype[name].base == np.float64 for name in self.data.dtype.names):
+            self.values = self.data.view(np.float64).reshape(capacity, -1)
+        self.host_ns = np.zeros(capacity, dtype=np.int64)
+        self.capacity = capacity
+        self.count = 0 # total samples ever appended
+
+    def append_bytes(self, payload, host_ns: int = 0):
+        slot = self.count % self.capacity
+        self.raw[slot] = np.frombuffer(payload, dtype=np.uint8)
+        self.host_ns[slot] = host_ns
+        self.count += 1
+
+    # takes the text fields of an ascii message, numpy does the float conversion
+    def append_fields(self, fields: list, host_ns: int = 0):
+        slot = self.count % self.capacity
+        self.values[slot] = fields
+        self.host_ns[slot] = host_ns
+        self.count += 1
+
+    def append(self, row, host_ns: int = 0):
+        slot = self.count % self.capacity
+        self.data[slot] = row
+        self.host_ns[slot] = host_ns
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def latest(self, n=None) -> np.ndarray:
+        n = len(self) if n is None else min(n, len(self))
+        end = self.count % self.capacity
+        if n <= end:
+            return self.data[end - n:end].copy()
+        return np.concatenate((self.data[self.capacity - (n - end):], self.data[:end]))
+
+    # host times of the samples latest(n) returns
+    def latest_host_ns(self, n=None) -> np.ndarray:
+        n = len(self) if n is None else min(n, len(self))
+        end = self.count % self.capacity
+        if n <= end:
+            return self.host_ns[end - n:end].copy()
+        return np.concatenate((self.host_ns[self.capacity - (n - end):], self.host_ns[:end]))
+
+# Fixed-record ring buffer in /dev/shm, so other processes can read decoded samples without
+# parsing serial text. One process writes, any number read.
+# Layout is a 64 byte header, the dtype description, then capacity records.
+# The writer fills a slot and then bumps write_count, readers check write_count again after copying
+# to throw out anything the writer lapped while they were reading
+class SharedSampleRing():
+    MAGIC = b'VNSHM001'
+    HEADER = struct.Struct('<8sIIIIQ') # magic, data offset, capacity, itemsize, descr length, write count
+    COUNT_OFFSET = 24
+
+    def __init__(self, path: str, writable: bool):
+        self.path = path
+        flags = os.O_RDWR if writable else os.O_RDONLY
+        fd = os.open(path, flags)
+        try:
+            self.map = mmap.mmap(fd, 0, prot=mmap.PROT_READ | (mmap.PROT_WRITE if writable else 0))
+        finally:
+            os.close(fd)
+        magic, data_offset, capacity, itemsize, descr_len, _ = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path} is not a vn100 sample ring")
+        descr = self.map[self.HEADER.size:self.HEADER.size + descr_len].decode('ascii')
+        self.dtype = np.lib.format.descr_to_dtype(ast.literal_eval(descr))
+        self.capacity = capacity
+        self.write_count = np.frombuffer(self.map, dtype=np.uint64, count=1, offset=self.COUNT_OFFSET)
+        # zero-copy views of the records, as samples and as raw bytes
+        self.records = np.frombuffer(self.map, dtype=self.dtype, count=capacity, offset=data_offset)
+        self.raw = np.frombuffer(self.map, dtype=np.uint8, count=capacity * itemsize,
+                                 offset=data_offset).reshape(capacity, itemsize)
+
+    # makes a new ring, name is a file in /dev/shm unless it is a path
+    @classmethod
+    def create(cls, name: str, dtype, capacity: int = 4096):
+        path = name if '/' in name else os.path.join('/dev/shm', name)
+        dtype = np.dtype(dtype)
+        descr = repr(np.lib.format.dtype_to_descr(dtype)).encode('ascii')
+        # records start on a 64 byte boundary
+        data_offset = (cls.HEADER.size + len(descr) + 63) // 64 * 64
+        size = data_offset + capacity * dtype.itemsize
+        # built next to it and moved into place, a reader still mapping an old ring keeps that one intact
+        # rather than having it truncated under it
+        tmp = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            header = cls.HEADER.pack(cls.MAGIC, data_offset, capacity, dtype.itemsize, len(descr), 0)
+            os.pwrite(fd, header + descr, 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+        return cls(path, writable=True)
+
+    @classmethod
+    def open(cls, name: str):
+        return cls(name if '/' in name else os.path.join('/dev/shm', name), writable=False)
+
+    # writer side, row is one record's bytes(e.g. a SampleBuffer.raw row)
+    def publish(self, row):
+        count = int(self.write_count[0])
+        self.raw[count % self.capacity] = row
+        self.write_count[0] = count + 1
+
+    # reader side, a consistent copy of the newest n samples(fewer if the writer lapped us)
+    def latest(self, n: int) -> np.ndarray:
+        start_count = int(self.write_count[0])
+        n = min(n, start_count, self.capacity)
+        first = start_count - n
+        slots = np.arange(first, start_count) % self.capacity
+        copy = self.records[slots]
+        end_count = int(self.write_count[0])
+        # anything at or below end_count - capacity may have been overwritten while we copied
+        lost = max(0, end_count + 1 - self.capacity - first)
+        return copy[lost:]
+
+    # reader side, a consistent copy of everything published after count(the write count this returned last time)
+    # returns (records, write count, samples the writer lapped before we got to them)
+    def read_since(self, count: int) -> tuple:
+        start_count = int(self.write_count[0])
+        first = max(count, start_count - self.capacity)
+        slots = np.arange(first, start_count) % self.capacity
+        copy = self.records[slots]
+        end_count = int(self.write_count[0])
+        lost = max(0, end_count + 1 - self.capacity - first)
+        return copy[lost:], start_count, first - count + lost
+
+    def close(self):
+        self.records = self.raw = self.write_count = None
+        try:
+            self.map.close()
+        except BufferError:
+            # views of the records handed out are still around, the map closes once they are garbage collected
+            pass
+
+# Append-only binary log of every frame the reader sees, stamped with the host monotonic clock
+# File: a 32 byte header, then records of a 12 byte header(t_ns, length, kind) and a payload.
+# Every index_every frames an index record lists (t_ns, offset) of the frames before it, and close()
+# adds a footer pointing at the last index, so a log opens through mmap without scanning it
+class SessionRecorder():
+    MAGIC = b'VNREC001'
+    FOOTER_MAGIC = b'VNRECEND'
+    HEADER = struct.Struct('<8sqqI4x') # magic, start monotonic ns, start wall clock ns, index_every
+    RECORD = struct.Struct('<qHBx') # host monotonic ns, payload length, kind
+    FOOTER = struct.Struct('<8sQ') # magic, offset of the last index record
+    FRAME = 0
+    INDEX = 1
+    # an index payload(8 bytes, then 16 a frame) has to fit the record's 16 bit length
+    MAX_INDEX_EVERY = (0xFFFF - 8) // 16
+
+    def __init__(self, path: str, index_every: int = 1024):
+        if not 1 <= index_every <= self.MAX_INDEX_EVERY:
+            raise ValueError(f"index_every has to be between 1 and {self.MAX_INDEX_EVERY}, not {index_every}")
+        self.path = path
+        self.file = open(path, 'wb', buffering=1 << 20)
+        self.index_every = index_every
+        self.file.write(self.HEADER.pack(self.MAGIC, time.monotonic_ns(), time.time_ns(), index_every))
+        self.offset = self.HEADER.size
+        # (t_ns, offset) of the frames since the last index, and where that index was
+        self.pending_index = []
+        self.last_index = 0
+        self.frames = 0
+        # the reader writes while another thread may close
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def write(self, t_ns: int, frame):
+        with self.lock:
+            if self.closed:
+                return
+            self.pending_index.append((t_ns, self.offset))
+            self.write_record(t_ns, self.FRAME, frame)
+            self.frames += 1
+            if len(self.pending_index) >= self.index_every:
+                self.write_index(t_ns)
+
+    def write_record(self, t_ns: int, kind: int, payload):
+        self.file.write(self.RECORD.pack(t_ns, len(payload), kind))
+        self.file.write(payload)
+        self.offset += self.RECORD.size + len(payload)
+
+    # index payload: offset of the previous index, then (t_ns, offset) pairs
+    def write_index(self, t_ns: int):
+        entries = np.array(self.pending_index, dtype=np.int64)
+        payload = struct.pack('<Q', self.last_index) + entries.tobytes()
+        self.last_index = self.offset
+        self.write_record(t_ns, self.INDEX, payload)
+        self.pending_index = []
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            if self.pending_index:
+                self.write_index(self.pending_index[-1][0])
+            self.file.write(self.FOOTER.pack(self.FOOTER_MAGIC, self.last_index))
+            self.file.close()
+            self.closed = True
+
+# Reads a SessionRecorder log back through mmap
+class SessionLog():
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            # mmap can't map an empty file, and anything shorter than the header isn't a log anyway
+            if os.fstat(f.fileno()).st_size < SessionRecorder.HEADER.size:
+                raise ValueError(f"{path} is not a vn100 session log")
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, self.start_ns, self.start_wall_ns, self.index_every = SessionRecorder.HEADER.unpack_from(self.map, 0)
+        if magic != SessionRecorder.MAGIC:
+            raise ValueError(f"{path} is not a vn100 session log")
+        self.index = self.load_index()
+
+    # (t_ns, offset) of every indexed frame, following the index chain back from the footer
+    # a log that was never closed(e.g. the recorder crashed) gets scanned instead
+    def load_index(self) -> np.ndarray:
+        footer = SessionRecorder.FOOTER
+        magic, last_index = footer.unpack_from(self.map, len(self.map) - footer.size) \
+            if len(self.map) >= SessionRecorder.HEADER.size + footer.size else (b'', 0)
+        if magic != SessionRecorder.FOOTER_MAGIC:
+            return np.array([(t_ns, offset) for t_ns, offset, _ in self.scan()], dtype=np.int64).reshape(-1, 2)
+        blocks = []
+        offset = last_index
+        while offset:
+            _, length, _ = SessionRecorder.RECORD.unpack_from(self.map, offset)
+            payload = offset + SessionRecorder.RECORD.size
+            offset = struct.unpack_from('<Q', self.map, payload)[0]
+            blocks.append(np.frombuffer(self.map, dtype=np.int64, count=(length - 8) // 8,
+                                        offset=payload + 8).reshape(-1, 2))
+        if not blocks:
+            return np.empty((0, 2), dtype=np.int64)
+        return np.concatenate(blocks[::-1])
+
+    # walks the records from an offset, yielding (t_ns, offset, payload) for every frame
+    def scan(self, offset: int = None):
+        offset = SessionRecorder.HEADER.size if offset is None else offset
+        end = len(self.map)
+        record = SessionRecorder.RECORD
+        while offset + record.size <= end:
+            t_ns, length, kind = record.unpack_from(self.map, offset)
+            payload_end = offset + record.size + length
+            if payload_end > end or kind not in (SessionRecorder.FRAME, SessionRecorder.INDEX):
+                # footer, or the end of a log that was cut off
+                return
+            if kind == SessionRecorder.FRAME:
+                yield t_ns, offset, self.view[offset + record.size:payload_end]
+            offset = payload_end
+
+    # (t_ns, frame) for every frame, starting at start_ns(host monotonic) if given
+    def frames(self, start_ns: int = None):
+        offset = None
+        if start_ns is not None and len(self.index):
+            i = np.searchsorted(self.index[:, 0], start_ns)
+            if i >= len(self.index):
+                return
+            offset = int(self.index[i, 1])
+        for t_ns, _, frame in self.scan(offset):
+            if start_ns is None or t_ns >= start_ns:
+                yield t_ns, frame
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # frames handed out are still around, the map closes once they are garbage collected
+            pass
+
+class VNError(Exception):
+    def __init__(self, code: int):
+        self.code = code
+        super().__init__(VN_ERROR_CODES.get(code, 'Unknown Error'))
+
+# Splits the raw byte stream from the vn100 into $TYPE,fields*XX\r\n frames and binary packets
+# Bytes are read in bulk straight into a preallocated buffer and frames are found with find(),
+# so nothing gets decoded unless a handler asks for it
+class VNFramer():
+    def __init__(self, size: int = 65536):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # unparsed data lives in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+        self.bytes_in = 0
+        self.frames_in = 0
+        self.checksum_failures = 0
+
+        # where the frame last handed out sits in the buffer, see raw_frame()
+        self.frame_start = 0
+        self.frame_end = 0
+
+    # makes room at the back of the buffer by moving any partial frame to the front
+    def compact(self):
+        if self.start == 0:
+            if self.end == len(self.buffer):
+                # one frame bigger than the whole buffer, this is garbage
+                self.end = 0
+            return
+        remaining = self.end - self.start
+        self.buffer[0:remaining] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = remaining
+
+    # reads whatever is waiting on a nonblocking fd straight into the buffer, one syscall and no copies
+    # returns 0 when nothing is there
+    def read_fd(self, fd: int) -> int:
+        if len(self.buffer) - self.end < 4096:
+            self.compact()
+        try:
+            n = os.readv(fd, (self.view[self.end:],))
+        except (BlockingIOError, InterruptedError):
+            return 0
+        self.end += n
+        self.bytes_in += n
+        return n
+
+    # copies data in from somewhere other than a serial port(e.g. a recorded log)
+    def feed(self, data) -> int:
+        if len(self.buffer) - self.end < len(data):
+            self.compact()
+        n = min(len(data), len(self.buffer) - self.end)
+        self.buffer[self.end:self.end + n] = data[:n]
+        self.end += n
+        self.bytes_in += n
+        return n
+
+    # yields (msg_type, body) for every complete frame with a good checksum
+    # msg_type is bytes like b'VNRRG', body is a memoryview of the fields after it.
+    # Binary packets come out with the header(sync, groups and field masks) as msg_type
+    # and the payload as body. body points into the buffer, so it is only valid until the next read_fd/feed
+    def frames(self):
+        buffer = self.buffer
+        view = self.view
+        # position of the next binary sync byte, only searched for again once we pass it
+        sync = -1
+        while self.start < self.end:
+            if sync < self.start:
+                sync = buffer.find(b'\xfa', self.start, self.end)
+                if sync < 0:
+                    sync = self.end
+
+            if sync == self.start:
+                # binary packet, resync one byte later if the header or crc doesn't check out
+                available = self.end - sync
+                if available < 2:
+                    return
+                n_groups = _BINARY_GROUP_COUNTS[buffer[sync + 1]]
+                if n_groups is None:
+                    self.start = sync + 1
+                    continue
+                header_len = 2 + 2 * n_groups
+                if available < header_len:
+                    return
+                header = bytes(view[sync:sync + header_len])
+                layout = binary_layout(header)
+                if layout is None:
+                    self.start = sync + 1
+                    continue
+                total = header_len + layout.itemsize + 2
+                if available < total:
+                    return
+                # the crc over everything after the sync byte, including the crc itself, is 0
+                if vn_crc16(view[sync + 1:sync + total]):
+                    self.checksum_failures += 1
+                    self.start = sync + 1
+                    continue
+                self.start = sync + total
+                self.frames_in += 1
+                self.frame_start, self.frame_end = sync, sync + total
+                yield header, view[sync + header_len:sync + total - 2]
+                continue
+
+            # ascii frames can only sit between here and the next binary sync byte
+            end = buffer.find(b'\n', self.start, sync)
+            if end < 0:
+                dollar = buffer.find(b'$', self.start, sync)
+                if sync < self.end:
+                    # a binary packet cut this line short
+                    if dollar >= 0:
+                        self.checksum_failures += 1
+                    self.start = sync
+                    continue
+                # no complete line yet, drop anything in front of the next $
+                self.start = self.end if dollar < 0 else dollar
+                return
+            dollar = buffer.rfind(b'$', self.start, end)
+            star = buffer.rfind(b'*', self.start, end)
+            self.start = end + 1
+            if dollar < 0:
+                # leftover noise from the line before, not a frame
+                continue
+            if star < dollar:
+                self.checksum_failures += 1
+                continue
+            cks_end = end - 1 if buffer[end - 1] == 0x0D else end
+            if not vn_checksum_ok(view[dollar + 1:star], buffer[star + 1:cks_end]):
+                self.checksum_failures += 1
+                continue
+
+            comma = buffer.find(b',', dollar, star)
+            if comma < 0:
+                # no fields, e.g. the VNWNV echo
+                comma = star
+            self.frames_in += 1
+            self.frame_start, self.frame_end = dollar, end + 1
+            yield bytes(view[dollar + 1:comma]), view[comma + 1:star]
+
+    # the complete bytes of the frame last yielded by frames(), e.g. for forwarding or recording it
+    def raw_frame(self):
+        return self.view[self.frame_start:self.frame_end]
+
+# Waits for serial fds to become readable(epoll on linux), or for wake() from another thread
+# The wakeup pipe is what lets stop_reading_threads take effect straight away instead of after a read timeout
+class PortWaiter():
+    def __init__(self, fd: int = None):
+        self.selector = selectors.DefaultSelector()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+        if fd is not None:
+            self.add(fd)
+
+    # data comes back from wait() when fd is readable
+    def add(self, fd: int, data=None):
+        self.selector.register(fd, selectors.EVENT_READ, data)
+
+    # the data of every fd with something to read, empty on timeout or when woken
+    def wait(self, timeout: float) -> list:
+        ready = []
+        for key, _ in self.selector.select(timeout):
+            if key.fd == self.wake_read:
+                try:
+                    os.read(self.wake_read, 4096)
+                except BlockingIOError:
+                    pass
+            else:
+                ready.append(key.data)
+        return ready
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, b'\0')
+        except BlockingIOError:
+            # the pipe is full of wakeups already
+            pass
+
+    def close(self):
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+# turns a frame body into a list of field bytes
+def split_fields(body) -> list:
+    return bytes(body).split(b',') if len(body) else []
+
+# Background logging stage for the reader thread
+# The reader only ever does a put_nowait on a bounded queue, the printing happens on this thread.
+# Unhandled message types are coalesced into one line of counts every interval,
+# warnings and errors are passed through as soon as they come in
+# Something with its own loop(e.g. asyncio) can call drain() from it instead of starting the thread
+class MessageLog():
+    def __init__(self, interval: float = 5.0, maxsize: int = 4096):
+        self.queue = queue.Queue(maxsize)
+        self.interval = interval
+        self.dropped = 0
+        self.reported_drops = 0
+        # unhandled message types since the last report
+        self.counts = {}
+        self.next_report = time.monotonic() + interval
+        self.active = False
+        self.thread = None
+
+    def unhandled(self, msg_type: bytes):
+        self._put(('count', msg_type))
+
+    def warning(self, text: str):
+        self._put(('warn', text))
+
+    def error(self, text: str):
+        self._put(('error', text))
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # never block the reader, just keep track of what got lost
+            self.dropped += 1
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.active = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.active = False
+        # wakes the thread up rather than waiting out its queue timeout
+        self._put(('wake', None))
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=2.0)
+
+    def run(self):
+        self.next_report = time.monotonic() + self.interval
+        while self.active or not self.queue.empty():
+            try:
+                self.handle(*self.queue.get(timeout=max(0.0, min(self.next_report - time.monotonic(), 0.5))))
+            except queue.Empty:
+                pass
+            self.report_if_due()
+        self.report()
+
+    # handles everything queued so far without waiting, for callers that don't run the thread
+    def drain(self):
+        while not self.queue.empty():
+            self.handle(*self.queue.get_nowait())
+        self.report_if_due()
+
+    def handle(self, kind: str, payload):
+        if kind == 'count':
+            self.counts[payload] = self.counts.get(payload, 0) + 1
+        elif kind == 'warn':
+            warn(payload)
+        elif kind == 'error':
+            print(payload)
+
+    def report_if_due(self):
+        if time.monotonic() >= self.next_report:
+            self.report()
+            self.next_report = time.monotonic() + self.interval
+
+    def report(self):
+        counts, self.counts = self.counts, {}
+        if counts:
+            summary = ', '.join(f"{t.decode('ascii', errors='ignore')} x{n}" for t, n in counts.items())
+            print(f"Unhandled Messages (last {self.interval:g}s): {summary}")
+        if self.dropped != self.reported_drops:
+            print(f"Log queue full, dropped {self.dropped - self.reported_drops} log entries")
+            self.reported_drops = self.dropped
+
+# Histogram of durations in power of two nanosecond buckets, bucket i holds [2^(i-1), 2^i)
+# Recording is an int.bit_length() and a list increment, cheap enough for the reader
+class LatencyHistogram():
     def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns: int):
+        self.buckets[ns.bit_length()] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    # upper bound of the bucket the q quantile(0-1) falls in, None before anything is recorded
+    def percentile(self, q: float):
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                return 1 << i
+        return self.max_ns
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'total_ns': self.total_ns,
+            'mean_ns': self.total_ns / self.count if self.count else None,
+            'p50_ns': self.percentile(0.5),
+            'p99_ns': self.percentile(0.99),
+            'max_ns': self.max_ns,
+            'buckets': list(self.buckets),
+        }
+
+# Counters for the serial pipeline that aren't already kept by the framer or the sample buffers
+# Frames of the streamed outputs are counted by their SampleBuffer, so the hot path only pays for the parse timer
+class PipelineMetrics():
+    def __init__(self):
+        self.started = time.monotonic()
+        self.bytes_out = 0
+        self.commands_sent = 0
+        self.commands_timed_out = 0
+        # every frame that isn't a streamed output, e.g. VNRRG replies, by message type
+        self.frames = {}
+        self.vnerr_codes = {}
+        # time the reader spends framing and dispatching each read
+        self.parse_ns = LatencyHistogram()
+        # command write to matching reply(or VNERR)
+        self.command_rtt_ns = LatencyHistogram()
+
+    def count_frame(self, msg_type: bytes):
+        self.frames[msg_type] = self.frames.get(msg_type, 0) + 1
+
+# Prometheus style text exposition of an HSIEstimator.metrics_snapshot()
+def metrics_text(snapshot: dict, prefix: str = 'vn100') -> str:
+    lines = []
+    def metric(name, kind, value, labels=None):
+        if value is None:
+            return
+        if kind is not None:
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+        label_text = '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else ''
+        lines.append(f'{prefix}_{name}{label_text} {value}')
+
+    metric('uptime_seconds', 'gauge', f"{snapshot['uptime_s']:.3f}")
+    for name in ('bytes_in', 'bytes_out', 'frames_in', 'checksum_failures', 'malformed_messages',
+                 'commands_sent', 'commands_timed_out', 'log_dropped'):
+        metric(f'{name}_total', 'counter', snapshot[name])
+    for name, value in snapshot.get('rates', {}).items():
+        metric(name, 'gauge', f'{value:.6g}')
+    if snapshot['sensor_clock_offset_ns'] is not None:
+        metric('sensor_clock_offset_seconds', 'gauge', f"{snapshot['sensor_clock_offset_ns'] / 1e9:.9f}")
+        metric('sensor_clock_drift_ppm', 'gauge', f"{snapshot['sensor_clock_drift_ppm']:.3f}")
+
+    for i, (msg_type, n) in enumerate(sorted(snapshot['frames_by_type'].items())):
+        metric('frames_total', 'counter' if i == 0 else None, n, {'type': msg_type})
+    for i, (code, n) in enumerate(sorted(snapshot['vnerr_codes'].items())):
+        metric('vnerr_total', 'counter' if i == 0 else None, n, {'code': code})
+    for i, (kind, n) in enumerate((snapshot.get('tty_errors') or {}).items()):
+        metric('tty_errors_total', 'counter' if i == 0 else None, n, {'kind': kind})
+
+    for name in ('parse_ns', 'command_rtt_ns'):
+        histogram = snapshot[name]
+        base = name[:-3] + '_seconds'
+        lines.append(f'# TYPE {prefix}_{base} histogram')
+        cumulative = 0
+        for i, n in enumerate(histogram['buckets']):
+            cumulative += n
+            if n:
+                metric(f'{base}_bucket', None, cumulative, {'le': f'{(1 << i) / 1e9:.9g}'})
+        metric(f'{base}_bucket', None, histogram['count'], {'le': '+Inf'})
+        metric(f'{base}_sum', None, f"{histogram['total_ns'] / 1e9:.9g}")
+        metric(f'{base}_count', None, histogram['count'])
+    return '\n'.join(lines) + '\n'
+
+# Rewrites a metrics text file every interval on its own thread, e.g. for node_exporter's textfile collector
+# Rates are worked out between consecutive writes, the file is swapped in whole so readers never see half of it
+class MetricsFile():
+    def __init__(self, snapshot, path: str, interval: float = 5.0):
+        self.snapshot = snapshot
+        self.path = path
+        self.interval = interval
+        self.active = False
+        self.thread = None
+        self.last = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.active = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.active = False
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=2.0)
+        self.write()
+
+    def run(self):
+        while self.active:
+            self.write()
+            deadline = time.monotonic() + self.interval
+            while self.active and time.monotonic() < deadline:
+                time.sleep(min(0.1, self.interval))
+
+    def write(self):
+        snapshot = self.snapshot()
+        if self.last is not None:
+            elapsed = snapshot['uptime_s'] - self.last['uptime_s']
+            if elapsed > 0:
+                snapshot['rates'] = {
+                    'bytes_in_per_second': (snapshot['bytes_in'] - self.last['bytes_in']) / elapsed,
+                    'frames_in_per_second': (snapshot['frames_in'] - self.last['frames_in']) / elapsed,
+                }
+                if snapshot.get('baudrate'):
+                    # 10 bits on the wire per byte(start + 8 data + stop)
+                    snapshot['rates']['link_utilization'] = snapshot['rates']['bytes_in_per_second'] * 10 / snapshot['baudrate']
+        self.last = snapshot
+        tmp = f'{self.path}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(metrics_text(snapshot))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            warn(f'Could not write metrics to {self.path}: {e}')
+
+class HSIEstimator():
+    def __init__(self, port: str = '/dev/ttyAMA4', baudrate: int = 115200, name: str = 'Port 1'):
         # declare the parameters for the ports and baudrate
-        self.port = '/dev/ttyAMA4'
-        self.baudrate = 115200
+        # name is what the log messages call this port
+        self.name = name
+        self.port = port
+        self.baudrate = baudrate
+        # the rate the vn100 was at when we found it, put back before anything is saved
+        self.startup_baudrate = baudrate
 
         # some configuration for the ports
-        self.ser_port = serial.Serial(
-            self.port,
-            self.baudrate,
-            timeout=1,
-            rtscts=True
-        )
+        # no port means no device, e.g. when replaying a recorded session
+        self.ser_port = None
+        if self.port is not None:
+            self.ser_port = serial.Serial(
+                self.port,
+                self.baudrate,
+                timeout=1,
+                rtscts=True
+            )
 
         # Variables defining port status
         self.port_active = False
         self.port_thread = None
         self.thread_lock = threading.Lock()
+        # the reader sleeps in here between reads, see PortWaiter
+        self.port_waiter = None
+        # bytes that have to be waiting before the reader is woken(VMIN), more means fewer wakeups per message
+        self.read_min_bytes = 1
+        # longest a partial read waits for read_min_bytes to fill up before it is read anyway
+        self.read_flush_interval = 0.05 # seconds
+        # framing and decoding in a child process instead of the reader thread, see start_parser_process
+        self.parser_process = None
+        self.parser_conn = None
+        # how often the parent looks for new samples from the child
+        self.parser_poll_interval = 0.002 # seconds
+        # child's own link metrics, and samples it published faster than the parent took them
+        self.parser_metrics = None
+        self.parser_dropped = 0
+        # in the child, the pipe frames other than samples are sent back to the parent on
+        self.forward_frames = None
+        # real time priority(SCHED_FIFO, 1-99) and cpus for the reader thread, see enable_low_latency
+        self.reader_priority = None
+        self.reader_cpus = None
+        # driver error counts at the last check, None where the driver doesn't keep them
+        self.tty_errors = None
+        self.tty_error_interval = 1.0 # seconds
+        self.next_error_check_ns = 0
 
         # Variables for storing HSI configuration as stored in register 47
         # C is the C matrix in row-major order, 
@@ -32,57 +1209,549 @@ class HSIEstimator():
         self.hsi_after = {"C":[], 
                       "B":[]}
 
+        # Futures for commands waiting on a reply, keyed by (message type, register)
+        # The reader completes them when the matching response comes in
+        self.pending_lock = threading.Lock()
+        self.pending_responses = {}
+        self.pending_order = []
+        self.write_lock = threading.Lock()
+        self.response_timeout = 15 # seconds
+
+        # Settings for waiting on the hsi estimator to converge
+        # register 47 is polled every interval and we stop once C/B move less than the tolerance
+        # for settle_polls polls in a row, and the vehicle has been pointed in enough directions
+        self.hsi_max_wait = 120 # seconds
+        self.hsi_min_wait = 10 # seconds
+        self.hsi_poll_interval = 2.0 # seconds
+        self.hsi_tolerance = 1e-3
+        self.hsi_settle_polls = 3
+        self.hsi_min_coverage = 0.9
+        # answers for the calibration's prompts when it runs unattended(e.g. several sensors on a bench)
+        # None asks on the terminal. convergence_rate is 1-5
+        self.confirm_estimation = None
+        self.confirm_save = None
+        self.convergence_rate = None
+        # rate of the VNIMU stream used to check orientation coverage while rotating
+        self.coverage_rate = 20 # Hz
+
+        # frames the raw bytes coming off the port
+        self.framer = VNFramer()
+
+        # decoded binary output packets, one buffer per packet header
+        self.binary_samples = {}
+        # byte offset of the sensor startup time in the payload, for headers that carry it
+        self.startup_time_offsets = {}
+        # sensor startup clock against host time, fed from binary packets with time_startup
+        self.sensor_clock = SensorClock()
+
+        # decoded ascii async outputs, one buffer per message type(e.g. b'VNYMR')
+        self.ascii_samples = {}
+        self.sample_capacity = 65536
+        self.malformed_messages = 0
+
+        # callables run by the reader after every decoded sample, as listener(msg_type, samples)
+        self.sample_listeners = []
+        # records every frame the reader sees when set, see start_recording
+        self.recorder = None
+
+        # shared memory rings samples get published into, by message type
+        self.shared_rings = {}
+
+        # live hsi estimate and orientation coverage, fed from the raw magnetometer during the rotation phase
+        self.live_hsi = None
+        self.coverage = CoverageTracker()
+
+        # console output from the reader goes through here so it never waits on the terminal
+        self.log = MessageLog()
+
+        # runtime counters for the link and command path, see metrics_snapshot
+        self.metrics = PipelineMetrics()
+        # periodic text dump of the metrics when set, see start_metrics_file
+        self.metrics_file = None
+
     # just gets the checksum in order to complete the raw message
     def vn_checksum(self, payload: str) -> str:
-        x = 0
-        for ch in payload.encode('ascii'):
-            x ^= ch
-        return f'{x:02X}'
+        return f'{vn_xor8(payload.encode("ascii")):02X}'
 
     # completes the vectornav message with the raw message and checksum
     def write_full_vn_message(self, payload: str) -> bytes:
         cks = self.vn_checksum(payload)
         return f'${payload}*{cks}\r\n'.encode('ascii')
 
+    # registers a future that gets completed when the reply for msg_type/reg_id arrives
+    def expect_response(self, msg_type: str, reg_id=None) -> Future:
+        future = Future()
+        future.sent_ns = time.monotonic_ns()
+        with self.pending_lock:
+            self.pending_responses.setdefault((msg_type, reg_id), []).append(future)
+            self.pending_order.append((msg_type, reg_id))
+        return future
+
+    # hands the reply fields to the oldest caller waiting on msg_type/reg_id
+    def complete_response(self, msg_type: str, reg_id, fields: list):
+        with self.pending_lock:
+            waiting = self.pending_responses.get((msg_type, reg_id))
+            future = waiting.pop(0) if waiting else None
+            if future is not None:
+                self.pending_order.remove((msg_type, reg_id))
+        if future is not None and not future.done():
+            self.metrics.command_rtt_ns.record(time.monotonic_ns() - future.sent_ns)
+            future.set_result(fields)
+
+    # VNERR replies don't say which command failed, so fail the oldest one in flight
+    def fail_oldest_response(self, error: Exception):
+        with self.pending_lock:
+            if not self.pending_order:
+                return
+            key = self.pending_order.pop(0)
+            future = self.pending_responses[key].pop(0)
+        if not future.done():
+            self.metrics.command_rtt_ns.record(time.monotonic_ns() - future.sent_ns)
+            future.set_exception(error)
+
+    # stops waiting on a future, so a late reply can't be matched to it
+    def forget_response(self, future: Future):
+        with self.pending_lock:
+            for key, waiting in self.pending_responses.items():
+                if future in waiting:
+                    waiting.remove(future)
+                    self.pending_order.remove(key)
+                    self.metrics.commands_timed_out += 1
+                    break
+
+    # fails everything still waiting so no caller blocks on a closed port
+    def cancel_responses(self):
+        with self.pending_lock:
+            waiting = [f for futures in self.pending_responses.values() for f in futures]
+            self.pending_responses.clear()
+            self.pending_order.clear()
+        for future in waiting:
+            if not future.done():
+                future.set_exception(ConnectionError('Serial reader stopped before a response arrived'))
+
+    # figures out which reply a command payload will get back, e.g. ('VNRRG', 47)
+    def response_key(self, payload: str):
+        fields = payload.split(',')
+        if fields[0] in ('VNRRG', 'VNWRG'):
+            return fields[0], int(fields[1])
+        return fields[0], None
+
+    # sends any number of commands in one write, so they are all in flight at once
+    def send_commands(self, payloads: list) -> list:
+        futures = []
+        out = b''
+        for payload in payloads:
+            futures.append(self.expect_response(*self.response_key(payload)))
+            out += self.write_full_vn_message(payload)
+        with self.write_lock:
+            self.ser_port.write(out)
+            self.metrics.bytes_out += len(out)
+            self.metrics.commands_sent += len(payloads)
+        return futures
+
+    def send_command(self, payload: str) -> Future:
+        return self.send_commands([payload])[0]
+
+    # the future resolves to the register values as a list of strings
+    def read_register(self, reg_id: int) -> Future:
+        return self.send_command(f'VNRRG,{reg_id:02d}')
+
+    # pipelined version of read_register, one round trip for the whole batch
+    def read_registers(self, reg_ids: list) -> list:
+        return self.send_commands([f'VNRRG,{reg_id:02d}' for reg_id in reg_ids])
+
+    # the future resolves to the values echoed back by the vn100
+    def write_register(self, reg_id: int, values: list) -> Future:
+        values = ','.join(str(v) for v in values)
+        return self.send_command(f'VNWRG,{reg_id:02d},{values}')
+
+    # count of received lines dropped for a bad checksum
+    @property
+    def checksum_failures(self) -> int:
+        return self.framer.checksum_failures
+
+    # stores one already decoded sample, payload being its bytes in the buffer's layout
+    # binary payloads come straight from the frame, and the parser process hands its samples over this way
+    def add_decoded(self, msg_type: bytes, payload, host_ns: int):
+        binary = msg_type[0] == BINARY_SYNC
+        buffers = self.binary_samples if binary else self.ascii_samples
+        samples = buffers.get(msg_type)
+        if samples is None:
+            layout = binary_layout(msg_type) if binary else ascii_layout(msg_type)
+            samples = buffers[msg_type] = SampleBuffer(layout, self.sample_capacity)
+            fields = samples.data.dtype.fields
+            for name in STARTUP_TIME_FIELDS:
+                if name in fields:
+                    self.startup_time_offsets[msg_type] = fields[name][1]
+                    break
+        samples.append_bytes(payload, host_ns)
+        offset = self.startup_time_offsets.get(msg_type)
+        if offset is not None:
+            self.sensor_clock.update(int.from_bytes(payload[offset:offset + 8], 'little'), host_ns)
+        for listener in self.sample_listeners:
+            listener(msg_type, samples)
+
+    # handles a single validated frame from the framer, host_ns is the host monotonic time it arrived
+    def dispatch(self, msg_type: bytes, body, host_ns: int = 0):
+        # binary outputs are the high rate path, copy the payload straight into its buffer
+        if msg_type[0] == BINARY_SYNC:
+            self.add_decoded(msg_type, body, host_ns)
+            return
+
+        # then the ascii async outputs
+        if msg_type in ASCII_OUTPUTS:
+            samples = self.ascii_samples.get(msg_type)
+            if samples is None:
+                samples = self.ascii_samples[msg_type] = SampleBuffer(ascii_layout(msg_type), self.sample_capacity)
+            fields = split_fields(body)
+            if len(fields) != samples.values.shape[1]:
+                self.malformed_messages += 1
+                return
+            try:
+                samples.append_fields(fields, host_ns)
+            except ValueError:
+                # a field that isn't a number, the count isn't bumped so the half written slot is just reused
+                self.malformed_messages += 1
+                return
+            for listener in self.sample_listeners:
+                listener(msg_type, samples)
+            return
+
+        if self.forward_frames is not None:
+            # parsing in a child process, the parent handles everything but the sample streams
+            self.forward_frames.send(('frame', bytes(self.framer.raw_frame())))
+            return
+
+        # everything past here is rare enough to count frame by frame
+        self.metrics.count_frame(msg_type)
+
+        # TODO: Add more message type handling
+        # Register reads/writes echo the register id, followed by its values
+        if msg_type == b'VNRRG' or msg_type == b'VNWRG':
+            fields = bytes(body).decode('ascii').split(',')
+            try:
+                reg_id = int(fields[0])
+            except ValueError:
+                self.malformed_messages += 1
+                return
+            self.complete_response(msg_type.decode(), reg_id, fields[1:])
+
+        elif msg_type in (b'VNWNV', b'VNRFS', b'VNRST'):
+            self.complete_response(msg_type.decode(), None, bytes(body).decode('ascii').split(',') if len(body) else [])
+
+        elif msg_type == b'VNERR':
+            # there is some error in the vn100, print it to the logger
+            try:
+                code = int(body)
+            except ValueError:
+                self.malformed_messages += 1
+                return
+            self.metrics.vnerr_codes[code] = self.metrics.vnerr_codes.get(code, 0) + 1
+            error = VNError(code)
+            self.log.warning(
+                f'Error code {code} in vn100 node: {error}'
+            )
+            if code in VN_COMMAND_ERRORS:
+                self.fail_oldest_response(error)
+
+        else:
+            # We don't really care about other messages in this program, so just continue
+            self.log.unhandled(msg_type)
+
+    # runs everything waiting in the framer through dispatch, t_ns is the host time the bytes were read
+    # shared by the reader and replay so recorded sessions go down exactly the same path
+    def process_frames(self, t_ns: int):
+        framer = self.framer
+        recorder = self.recorder
+        # frames that came in ahead of others in the same read arrived earlier by at least the time the
+        # bytes behind them took on the wire, 10 bits a byte
+        byte_ns = 1e10 / self.baudrate
+        for msg_type, body in framer.frames():
+            if recorder is not None:
+                recorder.write(t_ns, framer.raw_frame())
+            self.dispatch(msg_type, body, t_ns - int((framer.end - framer.frame_end) * byte_ns))
+
+    # host monotonic times of the newest n samples in a buffer. Binary samples carrying the sensor's startup time
+    # are mapped through the sensor clock estimate, which takes out the serial buffering jitter, the rest get
+    # the time their frame was read at
+    def sample_times(self, samples: SampleBuffer, n=None) -> np.ndarray:
+        names = samples.data.dtype.names
+        for name in STARTUP_TIME_FIELDS:
+            if name in names and self.sensor_clock.offset_ns is not None:
+                return self.sensor_clock.to_host_ns(samples.latest(n)[name])
+        return samples.latest_host_ns(n)
+
+    # point in time copy of the link and command counters. Cheap enough to call from any thread at any rate
+    # frames_by_type counts streamed outputs by their sample buffer and everything else as it is dispatched
+    def metrics_snapshot(self) -> dict:
+        metrics = self.metrics
+        framer = self.framer
+        frames_by_type = {t.decode('ascii', errors='replace'): n for t, n in list(metrics.frames.items())}
+        for msg_type, samples in list(self.ascii_samples.items()):
+            frames_by_type[msg_type.decode()] = samples.count
+        for header, samples in list(self.binary_samples.items()):
+            frames_by_type[f'binary_{header[1:].hex()}'] = samples.count
+        snapshot = {
+            'uptime_s': time.monotonic() - metrics.started,
+            'baudrate': self.baudrate if self.ser_port is not None else None,
+            'bytes_in': framer.bytes_in,
+            'bytes_out': metrics.bytes_out,
+            'frames_in': framer.frames_in,
+            'frames_by_type': frames_by_type,
+            'checksum_failures': framer.checksum_failures,
+            'malformed_messages': self.malformed_messages,
+            'vnerr_codes': dict(metrics.vnerr_codes),
+            'commands_sent': metrics.commands_sent,
+            'commands_timed_out': metrics.commands_timed_out,
+            'log_dropped': self.log.dropped,
+            'tty_errors': dict(self.tty_errors) if self.tty_errors is not None else None,
+            'parse_ns': metrics.parse_ns.snapshot(),
+            'command_rtt_ns': metrics.command_rtt_ns.snapshot(),
+            # host monotonic ns at sensor startup time 0, and how fast the two clocks drift apart
+            'sensor_clock_offset_ns': self.sensor_clock.to_host_ns(0),
+            'sensor_clock_drift_ppm': self.sensor_clock.drift_ppm if self.sensor_clock.offset_ns is not None else None,
+        }
+        if self.parser_metrics is not None:
+            # the link side of things happens in the parser process, as of its last report
+            for name in ('bytes_in', 'frames_in', 'checksum_failures', 'malformed_messages', 'parse_ns', 'tty_errors'):
+                snapshot[name] = self.parser_metrics[name]
+            snapshot['parser_dropped'] = self.parser_dropped
+        return snapshot
+
+    # rewrites path with the metrics in text exposition format every interval while the reader runs
+    def start_metrics_file(self, path: str, interval: float = 5.0):
+        self.stop_metrics_file()
+        self.metrics_file = MetricsFile(self.metrics_snapshot, path, interval)
+        self.metrics_file.start()
+
+    def stop_metrics_file(self):
+        if self.metrics_file is not None:
+            self.metrics_file.stop()
+            self.metrics_file = None
+
+    # feeds a recorded session back through the framer and dispatch without a device
+    # speed is a multiple of real time, None runs as fast as possible. Returns (frames, seconds taken)
+    def replay(self, path: str, speed=1.0):
+        log = SessionLog(path)
+        framer = self.framer
+        frames = 0
+        t_first = None
+        t_start = time.monotonic_ns()
+        pending_ns = None
+        try:
+            for t_ns, frame in log.frames():
+                if t_ns != pending_ns and pending_ns is not None:
+                    # frames from the same read go through the framer together, like they did live
+                    self.process_frames(pending_ns)
+                if t_first is None:
+                    t_first = t_ns
+                if speed and t_ns != pending_ns:
+                    wait_ns = t_start + (t_ns - t_first) / speed - time.monotonic_ns()
+                    if wait_ns > 0:
+                        time.sleep(wait_ns / 1e9)
+                if len(framer.buffer) - framer.end < len(frame):
+                    self.process_frames(t_ns)
+                framer.feed(frame)
+                pending_ns = t_ns
+                frames += 1
+            if pending_ns is not None:
+                self.process_frames(pending_ns)
+        finally:
+            log.close()
+        return frames, (time.monotonic_ns() - t_start) / 1e9
+
+    # pyserial already put the tty in raw mode with a nonblocking fd, this sets VMIN/VTIME for the reader
+    # VMIN is how many bytes the kernel wants waiting before the fd polls readable, VTIME stays 0 since reads never block.
+    # pyserial resets both whenever it reconfigures the port, so it is redone after every baud change
+    def tune_tty(self):
+        fd = self.ser_port.fileno()
+        attrs = termios.tcgetattr(fd)
+        attrs[6][termios.VMIN] = self.read_min_bytes
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+    # changes the host side of the link only, see set_baud for moving both ends
+    def set_port_baud(self, baud: int):
+        self.ser_port.baudrate = baud
+        self.tune_tty()
+
+    # Opt-in low latency setup, call before start_reading_threads
+    # Asks the driver to hand received bytes up straight away(ASYNC_LOW_LATENCY) where it supports that,
+    # and has the reader thread run at SCHED_FIFO priority on the given cpus so nothing else on the host delays it.
+    # Both scheduling settings usually need root or CAP_SYS_NICE, the reader warns and carries on without them
+    def enable_low_latency(self, priority: int = None, cpus=None):
+        try:
+            self.ser_port.set_low_latency_mode(True)
+        except (ValueError, AttributeError) as e:
+            warn(f"Serial driver doesn't support low latency mode: {e}")
+        self.reader_priority = priority
+        self.reader_cpus = set(cpus) if cpus else None
+        # wake for every byte and never hold a short read back
+        self.read_min_bytes = 1
+        self.read_flush_interval = 0.01
+
+    # applies the reader's scheduling settings to the calling thread
+    def set_reader_scheduling(self):
+        if self.reader_cpus:
+            try:
+                os.sched_setaffinity(0, self.reader_cpus)
+            except OSError as e:
+                self.log.warning(f'Could not pin the reader to cpus {sorted(self.reader_cpus)}: {e}')
+        if self.reader_priority:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.reader_priority))
+            except OSError as e:
+                self.log.warning(f'Could not give the reader real time priority {self.reader_priority}: {e}')
+
+    # warns about any driver side errors since the last check, they mean bytes were lost before we read them
+    def check_tty_errors(self, fd: int):
+        counts = tty_error_counts(fd)
+        if counts is None:
+            return
+        if self.tty_errors is not None:
+            new = {k: n - self.tty_errors[k] for k, n in counts.items() if n != self.tty_errors[k]}
+            if new:
+                self.log.warning(f'Serial driver errors on {self.name}: ' + ', '.join(f'{k} +{n}' for k, n in new.items()))
+        self.tty_errors = counts
+
+    # one pass of the reader: reads whatever is waiting on fd and runs it through dispatch, returns the bytes read
+    # also used by readers that serve several ports from one thread
+    def read_available(self, fd: int) -> int:
+        n = self.framer.read_fd(fd)
+        if n:
+            t_ns = time.monotonic_ns()
+            self.process_frames(t_ns)
+            # the read timestamp doubles as the start of the parse timer, one clock call per read
+            self.metrics.parse_ns.record(time.monotonic_ns() - t_ns)
+            if t_ns >= self.next_error_check_ns and self.tty_errors is not None:
+                self.check_tty_errors(fd)
+                self.next_error_check_ns = t_ns + int(self.tty_error_interval * 1e9)
+        return n
+
+    # Optional mode where a child process owns the reads from the port and does the framing and decoding,
+    # so fitting and everything else in this process can't hold up byte ingestion through the GIL.
+    # Call before start_reading_threads, which then starts the child and a thread that follows it.
+    # The child publishes every sample into a shared memory ring per message type and sends the rest
+    # (register replies, errors) back as raw frames. Commands are still written from this process.
+    # The child gets the reader's scheduling, so call enable_low_latency first. Returns once the child has
+    # the port open, its open flushes the tty so anything sent before then would lose its reply
+    def start_parser_process(self, ring_capacity: int = 16384, timeout: float = 10.0):
+        if self.recorder is not None:
+            warn("Frames are parsed in the child process, they won't be recorded")
+        context = multiprocessing.get_context('spawn')
+        self.parser_conn, child_conn = context.Pipe()
+        self.parser_process = context.Process(
+            target=parser_process,
+            args=(child_conn, self.port, self.baudrate, self.name, f'vn100_{os.getpid()}_{self.name.replace(" ", "")}',
+                  ring_capacity, self.read_min_bytes, self.read_flush_interval, self.reader_priority, self.reader_cpus),
+            daemon=True
+        )
+        self.parser_process.start()
+        child_conn.close()
+        try:
+            ready = self.parser_conn.poll(timeout) and self.parser_conn.recv() == ('ready',)
+        except (EOFError, OSError):
+            ready = False
+        if not ready:
+            self.parser_process.terminate()
+            self.parser_conn.close()
+            self.parser_process = self.parser_conn = None
+            raise ConnectionError(f'Parser process for {self.name} did not open {self.port}')
+
+    # reader thread of the parser process mode: copies new samples out of the child's rings into the sample
+    # buffers(running the listeners like the reader would), and dispatches the frames the child sends back
+    def follow_parser(self):
+        conn = self.parser_conn
+        # msg_type -> [ring, write count read up to]
+        rings = {}
+        try:
+            while self.port_active:
+                try:
+                    # frames from the child wake us straight away, otherwise the rings are checked every poll interval
+                    ready = conn.poll(self.parser_poll_interval)
+                    while ready:
+                        kind, *payload = conn.recv()
+                        if kind == 'frame':
+                            self.framer.feed(payload[0])
+                            self.process_frames(time.monotonic_ns())
+                        elif kind == 'ring':
+                            msg_type, path = payload
+                            rings[msg_type] = [SharedSampleRing.open(path), 0]
+                        elif kind == 'metrics':
+                            self.parser_metrics = payload[0]
+                        ready = conn.poll()
+                    for msg_type, follow in rings.items():
+                        records, follow[1], lost = follow[0].read_since(follow[1])
+                        self.parser_dropped += lost
+                        if not len(records):
+                            continue
+                        raw = records.view(np.uint8).reshape(len(records), records.dtype.itemsize)
+                        host_ns = records['host_ns']
+                        for i in range(len(records)):
+                            self.add_decoded(msg_type, raw[i, 8:], int(host_ns[i]))
+                except (EOFError, OSError) as e:
+                    self.log.error(f'Parser process for {self.name} went away: {e}')
+                    break
+                except Exception as e:
+                    self.log.error(f'Error in {self.name}: {e}')
+        finally:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            self.parser_process.join(timeout=1.0)
+            if self.parser_process.is_alive():
+                self.parser_process.terminate()
+            conn.close()
+            for ring, _ in rings.values():
+                ring.close()
+            self.parser_process = self.parser_conn = None
+        print(f'Serial {self.name} Closing')
+
     def reader(self): 
+        fd = self.ser_port.fileno()
+        waiter = self.port_waiter
+        self.set_reader_scheduling()
+        self.check_tty_errors(fd)
         while self.port_active:
             try:
-                msg = self.ser_port.readline().decode('ascii', errors='ignore').strip()
-                if not msg:
-                    # empty messages, skip this
-                    continue
-                parsed_msg = msg.split('*')[0].split(',')
-                msg_type = parsed_msg[0].strip("$")
-                # TODO: Add more message type handling
-                # Check for the read register command for register 47(Storage for HSI Calibration)
-                if msg_type == 'VNRRG' and int(parsed_msg[1]) == 47:
-                    # if the before check hasn't been applied, this must be the first one. 
-                    if not self.hsi_before['C']: 
-                        self.hsi_before['C'] = parsed_msg[2:11]
-                        self.hsi_before['B'] = parsed_msg[11:14]
-                    elif not self.hsi_after['C']:
-                        self.hsi_after['C'] = parsed_msg[2:11]
-                        self.hsi_after['B'] = parsed_msg[11:14]
-                    else: 
-                        warn("HSI Requested more than 2 times. Something is wrong!")
-
-                elif msg_type == 'VNERR':
-                    # there is some error in the vn100, print it to the logger
-                    warn(
-                        f'Error code {parsed_msg[1]} in vn100 node'
-                    )
-
-                else:
-                    # We don't really care about other messages in this program, so just continue
-                    print(f"Unhandled Message: {msg}")
+                # read even after a timeout, in case fewer than read_min_bytes are sitting there
+                waiter.wait(self.read_flush_interval)
+                self.read_available(fd)
 
             except Exception as e:
-                print(f'Error in Port 1: {e}')
+                self.log.error(f'Error in {self.name}: {e}')
 
-        print('Serial Port 1 Closing')
+        print(f'Serial {self.name} Closing')
         return
 
-    def check_to_continue(self):
+    # sets up one of the binary outputs(registers 75-77)
+    # groups maps a group name to the fields wanted from it, e.g. {'common': ['time_startup', 'ypr']}
+    # the output rate is 800Hz / rate_divisor, async_mode picks the serial port(s) it goes out on
+    def configure_binary_output(self, groups: dict, rate_divisor: int = 1, output: int = 1, async_mode: int = 1) -> Future:
+        group_bits = 0
+        masks = []
+        for bit, group in enumerate(BINARY_GROUPS):
+            if group is None or group[0] not in groups:
+                continue
+            names = [name for name, _, _ in group[1]]
+            mask = 0
+            for field in groups[group[0]]:
+                mask |= 1 << names.index(field)
+            group_bits |= 1 << bit
+            masks.append(f'{mask:04X}')
+        return self.write_register(74 + output, [async_mode, rate_divisor, f'{group_bits:02X}'] + masks)
+
+    # splits the register 47 values into the C matrix(row-major) and B vector
+    def parse_hsi(self, fields: list) -> dict:
+        values = [float(v) for v in fields]
+        return {"C": values[0:9],
+                "B": values[9:12]}
+
+    # asks on the terminal unless an answer was already given
+    def check_to_continue(self, answer=None):
+        if answer is not None:
+            return answer
         while True: 
             try: 
                 passed = input('Would you like to continue? (y/n): ')
@@ -102,14 +1771,18 @@ class HSIEstimator():
             with self.thread_lock:
                 if not self.port_active:
                     self.port_active = True
+                    self.log.start()
+                    self.tune_tty()
+                    if self.parser_process is None and self.port_waiter is None:
+                        self.port_waiter = PortWaiter(self.ser_port.fileno())
 
                     if self.port_thread is None or not self.port_thread.is_alive():
                         self.port_thread = threading.Thread(
-                            target=self.reader,
+                            target=self.follow_parser if self.parser_process is not None else self.reader,
                             daemon=True
                         )
                         self.port_thread.start()
-                        print('Started Port 1 reading thread')
+                        print(f'Started {self.name} reading thread')
         except Exception as e:
             print(f'Exception! {e}')
 
@@ -118,29 +1791,234 @@ class HSIEstimator():
         with self.thread_lock:
             if self.port_active:
                 self.port_active = False
+                if self.port_waiter is not None:
+                    self.port_waiter.wake()
 
                 if self.port_thread and self.port_thread.is_alive():
                     self.port_thread.join(timeout=2.0)
+                if self.port_waiter is not None:
+                    self.port_waiter.close()
+                    self.port_waiter = None
+                self.log.stop()
+                self.close_shared()
+
+        self.cancel_responses()
+
+    # blocks until the future is completed by the reader, returns None on timeout
+    def wait_for_response(self, future: Future, timeout=None):
+        if timeout is None:
+            timeout = self.response_timeout
+        try:
+            return future.result(timeout=timeout)
+        except ResponseTimeout:
+            self.forget_response(future)
+            warn(f"No response from the vn100 after {timeout} seconds")
+        except (ConnectionError, VNError) as e:
+            warn(f"Command failed: {e}")
+        return None
+
+    # like wait_for_response, but for when not hearing back is an expected answer
+    def poll_response(self, future: Future, timeout: float):
+        try:
+            return future.result(timeout=timeout)
+        except ResponseTimeout:
+            self.forget_response(future)
+        except (ConnectionError, VNError):
+            pass
+        return None
+
+    # finds the baud rate the vn100 is talking at, trying the current one first
+    # needs the reading thread to be running. Returns the rate, or None if nothing answered
+    def probe_baud(self, candidates=None, timeout: float = 0.25):
+        if candidates is None:
+            candidates = sorted(VN_BAUD_RATES, key=lambda b: (b != self.baudrate, -b))
+        for baud in candidates:
+            self.set_port_baud(baud)
+            self.ser_port.reset_input_buffer()
+            values = self.poll_response(self.read_register(5), timeout)
+            if values and int(values[0]) == baud:
+                self.baudrate = baud
+                return baud
+        self.set_port_baud(self.baudrate)
+        return None
+
+    # pipelines a batch of register reads and checks they all come back clean
+    def link_check(self, n_reads: int = 20, timeout: float = 1.0) -> bool:
+        failures = self.checksum_failures
+        futures = self.read_registers([5] * n_reads)
+        deadline = time.monotonic() + timeout
+        ok = all(self.poll_response(f, max(0.0, deadline - time.monotonic())) for f in futures)
+        return ok and self.checksum_failures == failures
+
+    # moves both ends of the link to a new baud rate and makes sure it still works
+    # the vn100 acks at the old rate, then switches. Falls back to the old rate if the check fails
+    def set_baud(self, baud: int) -> bool:
+        old_baud = self.baudrate
+        if baud == old_baud:
+            return True
+        ack = self.poll_response(self.write_register(5, [baud]), 1.0)
+        # give the ack time to leave the uart before switching under it
+        time.sleep(0.05)
+        self.set_port_baud(baud)
+        self.ser_port.reset_input_buffer()
+        self.baudrate = baud
+        if ack is not None and self.link_check():
+            return True
+
+        warn(f"Link check failed at {baud} baud, going back to {old_baud}")
+        if self.probe_baud() is None:
+            warn("Lost the vn100 while changing baud rate!")
+            return False
+        if self.baudrate != old_baud:
+            self.poll_response(self.write_register(5, [old_baud]), 1.0)
+            time.sleep(0.05)
+            self.set_port_baud(old_baud)
+            self.baudrate = old_baud
+        return False
+
+    # finds the current rate, then steps up to the fastest rate up to max_baud that passes a link check
+    def negotiate_baud(self, max_baud: int) -> int:
+        found = self.probe_baud()
+        if found is None:
+            warn("Could not find the vn100 at any baud rate")
+            return self.baudrate
+        self.startup_baudrate = found
+        for baud in sorted(VN_BAUD_RATES, reverse=True):
+            if baud <= found or baud > max_baud:
+                continue
+            if self.set_baud(baud):
+                print(f"Serial link running at {baud} baud")
+                break
+        return self.baudrate
+
+
+    # raw (uncompensated) magnetometer samples from whichever stream has them, newest last
+    def raw_magnetometer(self, n=None) -> np.ndarray:
+        for header, samples in self.binary_samples.items():
+            if 'imu_uncomp_mag' in samples.data.dtype.names and len(samples):
+                return samples.latest(n)['imu_uncomp_mag'].astype(np.float64)
+        samples = self.ascii_samples.get(b'VNIMU')
+        if samples is not None and len(samples):
+            return samples.latest(n)['uncomp_mag']
+        return np.empty((0, 3))
+
+    # newest raw magnetometer sample in a buffer, or None if the stream doesn't carry one
+    def newest_raw_mag(self, samples: SampleBuffer):
+        names = samples.data.dtype.names
+        field = 'uncomp_mag' if 'uncomp_mag' in names else 'imu_uncomp_mag' if 'imu_uncomp_mag' in names else None
+        if field is None:
+            return None
+        return samples.data[(samples.count - 1) % samples.capacity][field]
+
+    # sample listener that feeds each new raw magnetometer sample to the live estimator
+    def update_live_hsi(self, msg_type: bytes, samples: SampleBuffer):
+        mag = self.newest_raw_mag(samples)
+        if mag is not None:
+            self.live_hsi.update(mag)
+
+    # sample listener that bins each new raw magnetometer sample into the coverage grid
+    def update_coverage(self, msg_type: bytes, samples: SampleBuffer):
+        mag = self.newest_raw_mag(samples)
+        if mag is not None:
+            self.coverage.update(mag)
+
+    def start_recording(self, path: str):
+        self.recorder = SessionRecorder(path)
+        print(f"Recording the session to {path}")
 
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+            print(f"Recorded {recorder.frames} frames to {recorder.path}")
+
+    # publishes every decoded msg_type sample(e.g. b'VNYMR') into a /dev/shm ring for other processes
+    # use b'binary' for the binary outputs. The ring is made when the first sample shows up
+    def publish_shared(self, msg_type: bytes, name: str, capacity: int = 4096):
+        self.shared_rings[msg_type] = (name, capacity, None)
+        if self.publish_samples not in self.sample_listeners:
+            self.sample_listeners.append(self.publish_samples)
+
+    # closes the shared rings, the files stay in /dev/shm with the last samples for readers
+    # a ring is made again if samples keep coming
+    def close_shared(self):
+        for key, (name, capacity, ring) in list(self.shared_rings.items()):
+            if ring is not None:
+                self.shared_rings[key] = (name, capacity, None)
+                ring.close()
+
+    # sample listener that copies the newest sample into its shared ring
+    def publish_samples(self, msg_type: bytes, samples: SampleBuffer):
+        key = b'binary' if msg_type[0] == BINARY_SYNC else msg_type
+        if key not in self.shared_rings:
+            return
+        name, capacity, ring = self.shared_rings[key]
+        if ring is None:
+            ring = SharedSampleRing.create(name, samples.data.dtype, capacity)
+            self.shared_rings[key] = (name, capacity, ring)
+        elif ring.dtype != samples.data.dtype:
+            # a second binary layout, only the first one is published
+            return
+        ring.publish(samples.raw[(samples.count - 1) % samples.capacity])
+
+    # on-host hard/soft iron estimate from the buffered raw magnetometer, same layout as hsi_before/hsi_after
+    def fit_hsi(self, n=None) -> dict:
+        return fit_ellipsoid(self.raw_magnetometer(n))
+
+    # polls register 47 until the estimate stops moving, returns False if it runs out of time
+    def wait_for_hsi_convergence(self) -> bool:
+        t_start = time.monotonic()
+        previous = None
+        settled = 0
+        warned_coverage = False
+        while time.monotonic() - t_start < self.hsi_max_wait:
+            time.sleep(self.hsi_poll_interval)
+            values = self.poll_response(self.read_register(47), self.hsi_poll_interval)
+            if not values:
+                continue
+            hsi = np.array(values[0:12], dtype=float)
+            elapsed = time.monotonic() - t_start
+            # bin with the latest compensation, re-binning everything so far if the hard iron moved a lot
+            if previous is not None and np.linalg.norm(hsi[9:12] - previous[9:12]) > 0.05:
+                n_samples = self.coverage.samples
+                self.coverage.set_compensation(hsi[0:9], hsi[9:12])
+                self.coverage.reset()
+                self.coverage.update_many(self.raw_magnetometer(n_samples))
+            else:
+                self.coverage.set_compensation(hsi[0:9], hsi[9:12])
+            coverage = self.coverage.coverage
+            if coverage is None and not warned_coverage:
+                warn("No magnetometer stream, can't check orientation coverage. Going on convergence alone.")
+                warned_coverage = True
+
+            change = np.inf if previous is None else np.max(np.abs(hsi - previous))
+            settled = settled + 1 if change < self.hsi_tolerance else 0
+            previous = hsi
+            live_b = ''
+            if self.live_hsi is not None and self.live_hsi.count >= 100:
+                try:
+                    live_b = ', on-host B [' + ', '.join(f'{b:.4f}' for b in self.live_hsi.estimate()['B']) + ']'
+                except (ValueError, np.linalg.LinAlgError):
+                    pass
+            print(f"{elapsed:5.1f}s: change in C/B {change:.1e}, "
+                  f"coverage {'n/a' if coverage is None else f'{coverage:.0%}'}{live_b}")
+
+            if (settled >= self.hsi_settle_polls and elapsed >= self.hsi_min_wait
+                    and (coverage is None or coverage >= self.hsi_min_coverage)):
+                return True
+        return False
 
     def run_hsi_calibration(self):
         # Step 0: Set async data frequency to 0 so we can see all messages on port 1
         print("Turning Serial Port Async Messages Off")
-        freq_off_msg = self.write_full_vn_message('VNWRG,07,0,1')
-        self.ser_port.write(freq_off_msg)
+        self.wait_for_response(self.write_register(7, [0, 1]))
 
         # Step 1: Check the value of the hsi register for a baseline
         print("Checking Value for HSI Parameters Currently")
-        check_hsi_msg = self.write_full_vn_message(f"VNRRG,47")
-        self.ser_port.write(check_hsi_msg)
-
-        t_start = time.time()
-        t_now = time.time()
-        timeout = 15 # seconds
         # wait until hsi has been updated
-        while (not self.hsi_before['C']) and (t_now - t_start < timeout):
-            t_now = time.time()
-        if self.hsi_before['C']:
+        hsi_values = self.wait_for_response(self.read_register(47))
+        if hsi_values:
+            self.hsi_before = self.parse_hsi(hsi_values)
             print("HSI has been updated. Values are:")
 
             print(f"C = [{self.hsi_before['C'][0]},{self.hsi_before['C'][1]},{self.hsi_before['C'][2]}]\n"
@@ -149,42 +2027,57 @@ class HSIEstimator():
             
             print(f"B = [{self.hsi_before['B'][0]}, {self.hsi_before['B'][1]}, {self.hsi_before['B'][2]}]")
 
-        cont = self.check_to_continue()
+        cont = self.check_to_continue(self.confirm_estimation)
         if not cont: 
             print("Stopping Before The HSI Estimation Step")
             return 
         
         # Step 2: Send the message to start the hsi estimation process 
         print("Moving on to HSI Estiamtion Step")
-        getting_input = True
+        getting_input = self.convergence_rate is None
+        if not getting_input:
+            self.write_register(44, [1, 1, self.convergence_rate])
         while getting_input: 
             try:
                 conv_rate = input("What convergence rate would you like? (1-5): ")
                 if float(conv_rate) <= 5 and float(conv_rate) >= 1: 
                     getting_input = False
-                    start_msg = self.write_full_vn_message(f"VNWRG,44,1,1,{conv_rate}")
-                    self.ser_port.write(start_msg)
+                    self.write_register(44, [1, 1, conv_rate])
                 else: 
                     warn("Invalid Convergence Rate! It must be between 1 and 5! Give it another shot.")
             except KeyboardInterrupt: 
                 print("HSI Input Never Gathered. Stopping Program...")
 
-        # Step 3: Wait for about 120 seconds for hsi to converge as we spin the robot 
-        print("Waiting 2min for the HSI estimation process to complete.")
+        # Step 3: Wait up to 120 seconds for hsi to converge as we spin the robot 
+        print(f"Waiting up to {self.hsi_max_wait:g}s for the HSI estimation process to complete.")
         print("While this is running, please rotate the vehicle in all axes, trying to go through all positions")
-        wait_time = 120 
-        time.sleep(wait_time)
+        # stream the raw magnetometer so we can see which way the vehicle has been pointed
+        async_type = self.wait_for_response(self.read_register(6))
+        self.live_hsi = RecursiveHSIEstimator()
+        self.coverage = CoverageTracker()
+        if self.hsi_before['C']:
+            self.coverage.set_compensation(self.hsi_before['C'], self.hsi_before['B'])
+        self.sample_listeners += [self.update_live_hsi, self.update_coverage]
+        self.send_commands([f"VNWRG,06,{ASCII_OUTPUT_TYPES[b'VNIMU']},1", f"VNWRG,07,{self.coverage_rate},1"])
+        if self.wait_for_hsi_convergence():
+            print("HSI estimate has converged.")
+        else:
+            print("HSI estimate did not settle in time, using the latest values.")
+        self.sample_listeners.remove(self.update_live_hsi)
+        self.sample_listeners.remove(self.update_coverage)
+        if self.coverage.coverage is not None and self.coverage.coverage < self.hsi_min_coverage:
+            warn(f"Only {self.coverage.coverage:.0%} of orientations were covered while rotating. "
+                 "The estimate may be poor, think about running the calibration again before saving.")
+        # async back off for the rest of the calibration, and back to the output type it had
+        self.wait_for_response(self.write_register(7, [0, 1]))
+        if async_type:
+            self.wait_for_response(self.write_register(6, async_type))
 
         # Step 4: Check the value of the HSI register again 
-        self.ser_port.write(check_hsi_msg)
-
-        t_start = time.time()
-        t_now = time.time()
-        timeout = 15 # seconds
         # wait until hsi has been updated
-        while (not self.hsi_after['C']) and (t_now - t_start < timeout):
-            t_now = time.time()
-        if self.hsi_after['C']:
+        hsi_values = self.wait_for_response(self.read_register(47))
+        if hsi_values:
+            self.hsi_after = self.parse_hsi(hsi_values)
             print("HSI has been updated. Values are:")
 
             print(f"C = [{self.hsi_after['C'][0]},{self.hsi_after['C'][1]},{self.hsi_after['C'][2]}]\n"
@@ -193,39 +2086,206 @@ class HSIEstimator():
             
             print(f"B = [{self.hsi_after['B'][0]}, {self.hsi_after['B'][1]}, {self.hsi_after['B'][2]}]")
         
+        # compare against a fit of the raw magnetometer we streamed while rotating
+        mag = self.raw_magnetometer()
+        if len(mag) >= 100:
+            try:
+                hsi_host = fit_ellipsoid(mag)
+                print(f"On-host ellipsoid fit from {len(mag)} samples:")
+                print(f"C = [{hsi_host['C'][0]:.5f},{hsi_host['C'][1]:.5f},{hsi_host['C'][2]:.5f}]\n"
+                      f"    [{hsi_host['C'][3]:.5f},{hsi_host['C'][4]:.5f},{hsi_host['C'][5]:.5f}]\n"
+                      f"    [{hsi_host['C'][6]:.5f},{hsi_host['C'][7]:.5f},{hsi_host['C'][8]:.5f}]\n]")
+                print(f"B = [{hsi_host['B'][0]:.5f}, {hsi_host['B'][1]:.5f}, {hsi_host['B'][2]:.5f}]")
+            except (ValueError, np.linalg.LinAlgError) as e:
+                warn(f"On-host ellipsoid fit failed: {e}")
+        
         # Step 5: Stop the estimation process, apply changes if asked
         print("Stopping the estimation process and applying changes to the measurements.")
-        start_msg = self.write_full_vn_message(f"VNWRG,44,0,3,1")
-        self.ser_port.write(start_msg)
+        self.wait_for_response(self.write_register(44, [0, 3, 1]))
 
         # Step 6: Save the register(if we want to)
         print("Moving on to save the register.")
-        cont = self.check_to_continue()
+        cont = self.check_to_continue(self.confirm_save)
         if not cont: 
             print("Stopping Before Saving the Results!")
             return 
         
-        reset_async_output = self.write_full_vn_message("VNWRG,7,40,1") # back to 40Hz
-        self.ser_port.write(reset_async_output)
+        # back to 40Hz, and wait for the vn100 to take it before saving
+        self.wait_for_response(self.write_register(7, [40, 1]))
+
+        # don't save a faster baud rate, the robot's driver expects the one we started with
+        self.set_baud(self.startup_baudrate)
 
-        # now wait a second and save the data: 
-        time.sleep(1)
-        save_settings_msg = self.write_full_vn_message("VNWNV")
-        self.ser_port.write(save_settings_msg)
+        # now save the data: 
+        self.wait_for_response(self.send_command("VNWNV"))
         print("HSI process has completed and saved. Have a good day and good luck!")
         return 
 
+# Child side of HSIEstimator.start_parser_process: reads and decodes the port, publishes every sample into
+# a SharedSampleRing per message type(host_ns first, then the sample) and sends everything else to the parent
+def parser_process(conn, port: str, baudrate: int, name: str, ring_prefix: str, ring_capacity: int,
+                   read_min_bytes: int, read_flush_interval: float, priority: int = None, cpus: set = None):
+    estimator = HSIEstimator(port, baudrate, name)
+    estimator.read_min_bytes = read_min_bytes
+    estimator.reader_priority = priority
+    estimator.reader_cpus = cpus
+    estimator.forward_frames = conn
+    rings = {}
+    rows = {}
+
+    def publish(msg_type: bytes, samples: SampleBuffer):
+        ring = rings.get(msg_type)
+        if ring is None:
+            key = f'binary_{msg_type[1:].hex()}' if msg_type[0] == BINARY_SYNC else msg_type.decode()
+            dtype = samples.data.dtype
+            # the sample's own layout moved along by 8 bytes, padding and all, so its raw row copies in as is
+            layout = np.dtype({
+                'names': ['host_ns', *dtype.names],
+                'formats': ['<i8', *(dtype.fields[field][0] for field in dtype.names)],
+                'offsets': [0, *(8 + dtype.fields[field][1] for field in dtype.names)],
+                'itemsize': 8 + dtype.itemsize,
+            })
+            ring = rings[msg_type] = SharedSampleRing.create(f'{ring_prefix}_{key}', layout, ring_capacity)
+            rows[msg_type] = np.empty(ring.dtype.itemsize, dtype=np.uint8)
+            conn.send(('ring', msg_type, ring.path))
+        slot = (samples.count - 1) % samples.capacity
+        row = rows[msg_type]
+        row[:8] = samples.host_ns[slot:slot + 1].view(np.uint8)
+        row[8:] = samples.raw[slot]
+        ring.publish(row)
+
+    estimator.sample_listeners.append(publish)
+    fd = estimator.ser_port.fileno()
+    estimator.tune_tty()
+    estimator.check_tty_errors(fd)
+    waiter = PortWaiter(fd)
+    # the parent only ever sends the stop, and closing its end wakes us too
+    waiter.add(conn.fileno(), conn)
+    estimator.log.start()
+    # this process is the reader now
+    estimator.set_reader_scheduling()
+    conn.send(('ready',))
+    next_report = time.monotonic()
+    try:
+        while conn not in waiter.wait(read_flush_interval):
+            estimator.read_available(fd)
+            if time.monotonic() >= next_report:
+                conn.send(('metrics', estimator.metrics_snapshot()))
+                next_report = time.monotonic() + 1.0
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    finally:
+        for ring in rings.values():
+            ring.close()
+            os.unlink(ring.path)
+        waiter.close()
+        estimator.log.stop()
+        estimator.ser_port.close()
+
+# replays a recorded session and re-runs the on-host calibration over it
+def replay_session(path: str, speed: float):
+    estimator = HSIEstimator(port=None)
+    estimator.coverage = CoverageTracker()
+    estimator.live_hsi = RecursiveHSIEstimator()
+    estimator.sample_listeners += [estimator.update_live_hsi, estimator.update_coverage]
+    estimator.log.start()
+    frames, seconds = estimator.replay(path, speed or None)
+    estimator.log.stop()
+
+    print(f"Replayed {frames} frames in {seconds:.2f}s ({frames / max(seconds, 1e-9):.0f} frames/s)")
+    print(f"Checksum failures: {estimator.checksum_failures}, malformed messages: {estimator.malformed_messages}")
+    for msg_type, samples in estimator.ascii_samples.items():
+        print(f"{msg_type.decode()}: {samples.count} samples")
+    for header, samples in estimator.binary_samples.items():
+        print(f"binary {header.hex()}: {samples.count} samples")
+
+    mag = estimator.raw_magnetometer()
+    if len(mag) >= 100:
+        try:
+            hsi_host = fit_ellipsoid(mag)
+            print(f"On-host ellipsoid fit from {len(mag)} samples: C = {np.round(hsi_host['C'], 5).tolist()}, "
+                  f"B = {np.round(hsi_host['B'], 5).tolist()}")
+            hsi_live = estimator.live_hsi.estimate()
+            print(f"Recursive estimate: C = {np.round(hsi_live['C'], 5).tolist()}, "
+                  f"B = {np.round(hsi_live['B'], 5).tolist()}")
+        except (ValueError, np.linalg.LinAlgError) as e:
+            warn(f"On-host fit failed: {e}")
+        if estimator.coverage.coverage is not None:
+            print(f"Orientation coverage: {estimator.coverage.coverage:.0%}")
+
 def main(args=None):
+    parser = argparse.ArgumentParser(description='Hard/Soft Iron calibration for the VN100')
+    parser.add_argument('--port', default='/dev/ttyAMA4')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--max-baud', type=int, default=None,
+                        help='probe the vn100 and move the link up to this baud rate for the session')
+    parser.add_argument('--max-wait', type=float, default=120,
+                        help='longest time to wait for the hsi estimate to converge, in seconds')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='how often to check the hsi estimate, in seconds')
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+                        help='largest change in C/B between polls that counts as converged')
+    parser.add_argument('--publish', action='append', default=[],
+                        help='publish decoded samples of this type(e.g. VNYMR, or binary) to /dev/shm/vn100_<type>. Can be repeated')
+    parser.add_argument('--record', default=None,
+                        help='record every frame from the vn100 to this file')
+    parser.add_argument('--replay', default=None,
+                        help='replay a recorded session instead of talking to the vn100')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed as a multiple of real time, 0 for as fast as possible')
+    parser.add_argument('--metrics-file', default=None,
+                        help='keep link and command metrics in this file in prometheus text format')
+    parser.add_argument('--metrics-interval', type=float, default=5.0,
+                        help='how often to rewrite the metrics file, in seconds')
+    parser.add_argument('--low-latency', action='store_true',
+                        help='set the serial driver to low latency mode where it supports it')
+    parser.add_argument('--rt-priority', type=int, default=None,
+                        help='SCHED_FIFO priority(1-99) for the reader thread, needs root or CAP_SYS_NICE')
+    parser.add_argument('--cpu', type=int, action='append', default=[],
+                        help='pin the reader thread to this cpu. Can be repeated')
+    parser.add_argument('--parser-process', action='store_true',
+                        help='read and decode the port in a child process, away from the calibration and its GIL')
+    args = parser.parse_args(args)
+
+    if args.replay:
+        replay_session(args.replay, args.speed)
+        return
+
     #Instantiate the HSI Estimator
-    estimator = HSIEstimator()
+    estimator = HSIEstimator(args.port, args.baud)
+    estimator.hsi_max_wait = args.max_wait
+    estimator.hsi_poll_interval = args.poll_interval
+    estimator.hsi_tolerance = args.tolerance
+    for msg_type in args.publish:
+        estimator.publish_shared(msg_type.encode('ascii'), f'vn100_{msg_type}')
+
+    if args.record:
+        estimator.start_recording(args.record)
+    if args.metrics_file:
+        estimator.start_metrics_file(args.metrics_file, args.metrics_interval)
+    if args.low_latency or args.rt_priority or args.cpu:
+        estimator.enable_low_latency(args.rt_priority, args.cpu)
+    if args.parser_process:
+        estimator.start_parser_process()
 
     #First, start the reading thread
     estimator.start_reading_threads()
 
+    #Find the vn100 and speed up the link if we were asked to
+    if args.max_baud:
+        estimator.negotiate_baud(args.max_baud)
+
     #Now, run the series of commands for hsi calibration
     estimator.run_hsi_calibration()
+
+    #Put the baud rate back if we stopped early
+    if args.max_baud:
+        estimator.set_baud(estimator.startup_baudrate)
+
     #Now, stop reading threads
     estimator.stop_reading_threads()
+    estimator.stop_recording()
+    estimator.stop_metrics_file()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,279 @@
+import argparse
+import json
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+from VN100_HSIEstimator import HSIEstimator, VNFramer, binary_layout, vn_crc16
+from vn100_emulator import VehicleModel, vn_message
+
+# Benchmarks for the serial hot path: checksums, message building, framing, field parsing and the
+# whole reader. Each one reports messages/s, bytes/s, p50/p99 latency per message and bytes allocated
+# per message. Results can be saved as a baseline and later runs compared against it, so
+# slowdowns get caught before they reach the robots.
+#   python3 bench_vn100.py --save baseline.json
+#   python3 bench_vn100.py --compare baseline.json
+
+YMR_PAYLOAD = 'VNYMR,+123.456,-012.345,+001.234,+00.1234,-00.5678,+00.9012,-00.123,+00.456,-09.801,+0.001234,-0.005678,+0.009012'
+
+# header for a common group packet with time_startup, ypr and the imu(accel + gyro) fields
+BINARY_HEADER = b'\xfa\x01\x09\x02'
+
+# a capture of ascii VNIMU/VNYMR lines and binary packets, like the reader would see
+def make_stream(n_messages: int, binary_every: int = 4) -> tuple:
+    model = VehicleModel((0.08, -0.15, 0.21), np.eye(3))
+    layout = binary_layout(BINARY_HEADER)
+    frames = []
+    for i in range(n_messages):
+        sample = model.sample(i / 400)
+        if binary_every and i % binary_every == 0:
+            packet = np.zeros(1, dtype=layout)
+            packet['common_time_startup'] = i
+            packet['common_ypr'] = sample['ypr']
+            packet['common_imu'] = np.concatenate((sample['accel'], sample['gyro']))
+            body = BINARY_HEADER[1:] + packet.tobytes()
+            frames.append(b'\xfa' + body + struct.pack('>H', vn_crc16(body)))
+        else:
+            output = 'VNIMU' if i % 2 else 'VNYMR'
+            names = ('uncomp_mag', 'uncomp_accel', 'uncomp_gyro', 'temp', 'pres') if output == 'VNIMU' \
+                else ('ypr', 'mag', 'accel', 'gyro')
+            values = np.concatenate([np.atleast_1d(sample[name]) for name in names])
+            frames.append(vn_message(output + ',' + ','.join(f'{v:+.5f}' for v in values)))
+    return frames, b''.join(frames)
+
+# times fn(item) for every item, returning per-call latencies in ns
+def time_each(fn, items) -> np.ndarray:
+    latencies = np.empty(len(items), dtype=np.int64)
+    clock = time.perf_counter_ns
+    for i, item in enumerate(items):
+        t0 = clock()
+        fn(item)
+        latencies[i] = clock() - t0
+    return latencies
+
+# bytes allocated by fn(item) over all the items, freed again or not. tracemalloc slows everything down
+# so this is its own pass, after the timed one. Each call's peak counts, so a temporary
+# (e.g. an f-string thrown away before returning) shows up too.
+# Run one item through first, so one-time setup(e.g. sample buffers made on first use) isn't counted
+def allocated_bytes(fn, items) -> int:
+    tracemalloc.start()
+    total = 0
+    try:
+        for item in items:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            fn(item)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total
+
+# latencies and allocations can be None where a benchmark can't measure them
+def summarize(name: str, latencies, messages: int, n_bytes: int, seconds: float, alloc_bytes) -> dict:
+    return {
+        'name': name,
+        'messages_per_s': messages / seconds,
+        'bytes_per_s': n_bytes / seconds,
+        'p50_ns': float(np.percentile(latencies, 50)) if latencies is not None else None,
+        'p99_ns': float(np.percentile(latencies, 99)) if latencies is not None else None,
+        'alloc_bytes_per_message': alloc_bytes,
+    }
+
+def bench_per_call(name: str, fn, items: list, n_bytes: int) -> dict:
+    t0 = time.perf_counter()
+    latencies = time_each(fn, items)
+    seconds = time.perf_counter() - t0
+    alloc = allocated_bytes(fn, items[1:]) / max(len(items) - 1, 1)
+    return summarize(name, latencies, len(items), n_bytes, seconds, alloc)
+
+def bench_checksum(estimator: HSIEstimator, n: int) -> dict:
+    payloads = [YMR_PAYLOAD] * n
+    return bench_per_call('vn_checksum', estimator.vn_checksum, payloads, len(YMR_PAYLOAD) * n)
+
+def bench_write_message(estimator: HSIEstimator, n: int) -> dict:
+    payloads = [YMR_PAYLOAD] * n
+    return bench_per_call('write_full_vn_message', estimator.write_full_vn_message, payloads,
+                          (len(YMR_PAYLOAD) + 5) * n)
+
+# the stream in the 4KiB reads the reader would see
+def chunks(stream: bytes) -> list:
+    return [stream[offset:offset + 4096] for offset in range(0, len(stream), 4096)]
+
+# framing of a stream fed in 4KiB chunks, latency is per frame handed out
+def bench_framing(stream: bytes, n_messages: int) -> dict:
+    framer = VNFramer()
+    latencies = np.empty(n_messages + len(stream) // 4096 + 1, dtype=np.int64)
+    n = 0
+    clock = time.perf_counter_ns
+    t_start = time.perf_counter()
+    for offset in range(0, len(stream), 4096):
+        framer.feed(stream[offset:offset + 4096])
+        frames = framer.frames()
+        while True:
+            t0 = clock()
+            frame = next(frames, None)
+            if frame is None:
+                break
+            latencies[n] = clock() - t0
+            n += 1
+    seconds = time.perf_counter() - t_start
+
+    def frame_chunk(chunk):
+        framer.feed(chunk)
+        for _ in framer.frames():
+            pass
+    framer = VNFramer()
+    reads = chunks(stream)
+    frame_chunk(reads[0])
+    warm = framer.frames_in
+    alloc = allocated_bytes(frame_chunk, reads[1:]) / max(framer.frames_in - warm, 1)
+    return summarize('framing', latencies[:n], n, len(stream), seconds, alloc)
+
+# dispatch of already framed messages, i.e. field splitting and float parsing into the sample buffers
+def bench_parsing(estimator: HSIEstimator, frames: list) -> dict:
+    framer = VNFramer(len(b''.join(frames)) + 1)
+    framer.feed(b''.join(frames))
+    framed = [(msg_type, bytes(body)) for msg_type, body in framer.frames()]
+    return bench_per_call('field_parsing', lambda f: estimator.dispatch(f[0], f[1]), framed,
+                          sum(len(f) for f in frames))
+
+# the reader's path from raw bytes to decoded samples, the same loop replay uses.
+# latency is per 4KiB read, spread over the frames in it
+def bench_end_to_end(stream: bytes, n_messages: int) -> dict:
+    estimator = HSIEstimator(port=None)
+    framer = estimator.framer
+    latencies = np.empty(n_messages, dtype=np.float64)
+    clock = time.perf_counter_ns
+    t_start = time.perf_counter()
+    for offset in range(0, len(stream), 4096):
+        t0 = clock()
+        framer.feed(stream[offset:offset + 4096])
+        frames_before = framer.frames_in
+        estimator.process_frames(t0)
+        done = framer.frames_in - frames_before
+        if done:
+            latencies[frames_before:framer.frames_in] = (clock() - t0) / done
+    seconds = time.perf_counter() - t_start
+    frames = framer.frames_in
+
+    def process_chunk(chunk):
+        estimator.framer.feed(chunk)
+        estimator.process_frames(0)
+    estimator = HSIEstimator(port=None)
+    reads = chunks(stream)
+    process_chunk(reads[0])
+    warm = estimator.framer.frames_in
+    alloc = allocated_bytes(process_chunk, reads[1:]) / max(estimator.framer.frames_in - warm, 1)
+    return summarize('end_to_end', latencies[:frames], frames, len(stream), seconds, alloc)
+
+# a recorded session through HSIEstimator.replay as fast as possible, throughput only
+def bench_replay(path: str) -> dict:
+    estimator = HSIEstimator(port=None)
+    frames, seconds = estimator.replay(path, speed=None)
+    return summarize('replay', None, frames, estimator.framer.bytes_in, seconds, None)
+
+# the real reader thread on a pty, fed by the emulator at rate messages/s. Shows whether the
+# reader keeps up with the link rather than its top speed.
+# Latency is from when the emulator was due to send a binary packet(its time_startup) to the host time
+# the reader stamped it with, so it includes the emulator's own scheduling delay
+def bench_emulator(seconds: float, rate: float) -> dict:
+    from vn100_emulator import VNEmulator
+    emulator = VNEmulator(rate=rate)
+    threading.Thread(target=emulator.run, daemon=True).start()
+    estimator = HSIEstimator(emulator.path)
+    estimator.log.interval = 3600
+    estimator.start_reading_threads()
+    estimator.poll_response(estimator.configure_binary_output({'common': ['time_startup']}), 1.0)
+    time.sleep(seconds)
+    estimator.stop_reading_threads()
+    emulator.active = False
+    framer = estimator.framer
+    latencies = None
+    for samples in estimator.binary_samples.values():
+        sent_ns = int(emulator.t_start * 1e9) + samples.latest()['common_time_startup'].astype(np.int64)
+        latencies = samples.latest_host_ns(len(samples)) - sent_ns
+    return summarize('reader_pty', latencies, framer.frames_in, framer.bytes_in, seconds, None)
+
+# a result is a regression if throughput dropped, or p99 latency grew, by more than threshold,
+# or if allocations per message grew by more than alloc_threshold(plus a byte for amortized growth).
+# p99 and allocations are only compared where both runs measured them
+def compare(results: list, baseline: list, threshold: float, alloc_threshold: float = 0.1) -> list:
+    old = {r['name']: r for r in baseline}
+    regressions = []
+    for result in results:
+        before = old.get(result['name'])
+        if before is None:
+            continue
+        if result['messages_per_s'] < before['messages_per_s'] * (1 - threshold):
+            regressions.append(f"{result['name']}: {result['messages_per_s']:.0f} msg/s, "
+                               f"baseline {before['messages_per_s']:.0f}")
+        if result['p99_ns'] is not None and before['p99_ns'] is not None \
+                and result['p99_ns'] > before['p99_ns'] * (1 + threshold):
+            regressions.append(f"{result['name']}: p99 {result['p99_ns']:.0f} ns, baseline {before['p99_ns']:.0f}")
+        alloc, alloc_before = result['alloc_bytes_per_message'], before.get('alloc_bytes_per_message')
+        if alloc is not None and alloc_before is not None and alloc > alloc_before * (1 + alloc_threshold) + 1:
+            regressions.append(f"{result['name']}: {alloc:.1f} bytes allocated a message, baseline {alloc_before:.1f}")
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for the VN100 parsing and I/O path')
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--session', default=None, help='also replay this recorded session')
+    parser.add_argument('--emulator', type=float, default=0,
+                        help='also run the reader against the emulator for this many seconds')
+    parser.add_argument('--emulator-rate', type=float, default=5000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best one is kept')
+    parser.add_argument('--save', default=None, help='save the results as a baseline')
+    parser.add_argument('--compare', default=None, help='baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, as a fraction')
+    parser.add_argument('--alloc-threshold', type=float, default=0.1,
+                        help='allowed growth in bytes allocated a message against the baseline, as a fraction')
+    args = parser.parse_args(args)
+
+    estimator = HSIEstimator(port=None)
+    frames, stream = make_stream(args.messages)
+    benchmarks = [
+        lambda: bench_checksum(estimator, args.messages),
+        lambda: bench_write_message(estimator, args.messages),
+        lambda: bench_framing(stream, args.messages),
+        lambda: bench_parsing(estimator, frames),
+        lambda: bench_end_to_end(stream, args.messages),
+    ]
+    if args.session:
+        benchmarks.append(lambda: bench_replay(args.session))
+    # best of a few runs, so a busy machine doesn't show up as a regression
+    results = [max((bench() for _ in range(args.repeat)), key=lambda r: r['messages_per_s'])
+               for bench in benchmarks]
+    if args.emulator:
+        results.append(bench_emulator(args.emulator, args.emulator_rate))
+
+    # - for what a benchmark doesn't measure
+    def column(value, width: int, digits: int) -> str:
+        return f"{'-':>{width}}" if value is None else f"{value:>{width}.{digits}f}"
+
+    print(f"{'benchmark':<22}{'msg/s':>12}{'MB/s':>9}{'p50 ns':>10}{'p99 ns':>10}{'alloc B/msg':>13}")
+    for r in results:
+        print(f"{r['name']:<22}{r['messages_per_s']:>12.0f}{r['bytes_per_s'] / 1e6:>9.2f}"
+              f"{column(r['p50_ns'], 10, 0)}{column(r['p99_ns'], 10, 0)}{column(r['alloc_bytes_per_message'], 13, 1)}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.alloc_threshold)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import tty
+import numpy as np
+import struct
+import pytest
+
+from bench_vn100 import compare
+from VN100_HSIEstimator import (HSIEstimator, SensorClock, SessionLog, SessionRecorder, SharedSampleRing,
+                                VNFramer, binary_layout,
+                                decode_binary_packets, metrics_text, validate_lines, vn_crc16, vn_xor8)
+from vn100_asyncio import AsyncVN100
+from vn100_emulator import VNEmulator, vn_message
+from vn100_manager import VNManager
+from vn100_mux import MuxClient, VNMux
+
+# Smoke tests against the emulator, no hardware needed: python3 -m pytest -q test_vn100.py
+
+HARD_IRON = (0.08, -0.15, 0.21)
+
+@pytest.fixture
+def emulators(tmp_path):
+    running = []
+
+    def start(name: str = 'ttyVN100') -> VNEmulator:
+        emulator = VNEmulator(str(tmp_path / name), hard_iron=HARD_IRON)
+        thread = threading.Thread(target=emulator.run, daemon=True)
+        thread.start()
+        running.append((emulator, thread))
+        return emulator
+    yield start
+    for emulator, thread in running:
+        emulator.active = False
+        thread.join(timeout=2.0)
+
+@pytest.fixture
+def emulator(emulators):
+    return emulators()
+
+@pytest.fixture
+def estimator(emulator):
+    estimator = HSIEstimator(emulator.link)
+    estimator.response_timeout = 2.0
+    yield estimator
+    estimator.stop_reading_threads()
+    estimator.ser_port.close()
+
+# waits for check() to be true, up to timeout seconds
+def wait_until(check, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_unattended_calibration(emulator, estimator):
+    # tumble ten times faster, so a few seconds point the vehicle every way
+    attitude = emulator.model.attitude
+    emulator.model.attitude = lambda t: attitude(10 * t)
+    estimator.hsi_max_wait = 5
+    estimator.hsi_min_wait = 1
+    estimator.hsi_poll_interval = 0.25
+    estimator.coverage_rate = 200
+    estimator.confirm_estimation = True
+    estimator.confirm_save = True
+    estimator.convergence_rate = 3
+    estimator.start_reading_threads()
+    estimator.run_hsi_calibration()
+
+    assert np.allclose(estimator.hsi_after['B'], HARD_IRON, atol=0.02)
+    assert emulator.flash[47] == emulator.registers[47]
+    assert estimator.checksum_failures == 0
+
+def test_first_command_gets_its_reply(estimator):
+    estimator.start_reading_threads()
+    assert estimator.poll_response(estimator.read_register(1), 1.0) == ['VN-100T-CR']
+    assert estimator.poll_response(estimator.read_register(99), 1.0) is None
+
+def test_validate_lines():
+    body = b'VNRRG,01,VN-100T-CR'
+    xor = vn_message(body.decode())
+    crc = b'$' + body + f'*{vn_crc16(body):04X}\r\n'.encode()
+    lines = [
+        xor,
+        crc,
+        b'$' + body + f'*{vn_xor8(body):02x}\r\n'.encode(),  # lower case hex
+        xor.replace(xor[-4:-2], b'zz'),  # bad hex
+        crc[:-3] + b'G\r\n',  # bad hex in a crc16
+        xor[1:],  # no $
+        xor.replace(b'01', b'02'),  # checksum of a different line
+        b'$' + body + b'*1\r\n',  # neither 2 nor 4 digits
+        b'',
+    ]
+    assert validate_lines(lines).tolist() == [True, True, True, False, False, False, False, False, False]
+    assert validate_lines([]).tolist() == []
+
+# a common group time_startup + ypr packet
+YPR_HEADER = b'\xfa\x01\x09\x00'
+
+def binary_packet(header: bytes, payload: bytes) -> bytes:
+    body = header[1:] + payload
+    return b'\xfa' + body + struct.pack('>H', vn_crc16(body))
+
+def ypr_payload(t_ns: int) -> bytes:
+    packet = np.zeros(1, dtype=binary_layout(YPR_HEADER))
+    packet['common_time_startup'] = t_ns
+    packet['common_ypr'] = (1.0, 2.0, 3.0)
+    return packet.tobytes()
+
+def test_decode_binary_packets():
+    samples = decode_binary_packets(YPR_HEADER, [ypr_payload(1), ypr_payload(2)])
+    assert list(samples['common_time_startup']) == [1, 2]
+    assert samples['common_ypr'][1].tolist() == [1.0, 2.0, 3.0]
+    # a gps group header has no layout here
+    with pytest.raises(ValueError):
+        decode_binary_packets(b'\xfa\x08\x01\x00', [bytes(16)])
+
+def test_framer_resyncs_after_bad_binary_crc():
+    good = binary_packet(YPR_HEADER, ypr_payload(1))
+    bad = bytearray(binary_packet(YPR_HEADER, ypr_payload(2)))
+    bad[10] ^= 0xFF
+    ascii_frame = vn_message('VNRRG,01,VN-100T-CR')
+    framer = VNFramer()
+    # a stray sync byte, a packet with a bad crc, then good frames straight after it
+    framer.feed(b'\xfa\x00' + bytes(bad) + good + ascii_frame + good)
+    frames = [(bytes(msg_type), bytes(body)) for msg_type, body in framer.frames()]
+    assert [msg_type for msg_type, _ in frames] == [YPR_HEADER, b'VNRRG', YPR_HEADER]
+    assert frames[0][1] == ypr_payload(1)
+    assert framer.checksum_failures == 1
+
+def test_sensor_clock_offset_and_drift():
+    clock = SensorClock()
+    rng = np.random.default_rng(0)
+    # 100Hz for 30s off a sensor running 50ppm slow, host stamps up to 2ms late
+    sensor = np.arange(0, 30_000_000_000, 10_000_000)
+    host = 5_000_000_000 + sensor + sensor * 50e-6 + rng.exponential(200_000, len(sensor)).clip(0, 2_000_000)
+    for s_ns, h_ns in zip(sensor, host.astype(np.int64)):
+        clock.update(int(s_ns), int(h_ns))
+    assert abs(clock.drift_ppm - 50) < 2
+    # the lower envelope, so within the jitter's floor of the true send time
+    error = clock.to_host_ns(sensor[-100:]) - (5_000_000_000 + sensor[-100:] * (1 + 50e-6))
+    assert np.all(np.abs(error) < 50_000)
+    # a sensor reset starts the fit over
+    clock.update(0, 100_000_000_000)
+    assert clock.to_host_ns(0) == 100_000_000_000 and clock.drift == 0.0
+
+def test_metrics_text():
+    estimator = HSIEstimator(port=None)
+    for frame in (vn_message('VNYMR' + ',+1.0' * 12), vn_message('VNERR,08'), binary_packet(YPR_HEADER, ypr_payload(1))):
+        estimator.framer.feed(frame)
+        estimator.process_frames(time.monotonic_ns())
+    estimator.metrics.parse_ns.record(1500)
+    text = metrics_text(estimator.metrics_snapshot())
+    lines = text.splitlines()
+    assert 'vn100_frames_in_total 3' in lines
+    assert 'vn100_frames_total{type="VNYMR"} 1' in lines
+    assert 'vn100_frames_total{type="binary_010900"} 1' in lines
+    assert 'vn100_vnerr_total{code="8"} 1' in lines
+    assert 'vn100_parse_seconds_bucket{le="2.048e-06"} 1' in lines
+    assert 'vn100_parse_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'vn100_command_rtt_seconds_count 0' in lines
+    # every metric is declared once, and every sample line is a name and a number
+    types = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+    assert len(types) == len(set(types))
+    for line in lines:
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            assert name.startswith('vn100_')
+            float(value)
+
+def test_emulator_rejects_bad_commands(emulator, estimator):
+    estimator.start_reading_threads()
+    # good checksums, but no register, a register that isn't a number, and values that can't be stored
+    for payload in ('VNRRG', 'VNRRG,xx', 'VNWRG,07,abc', 'VNWRG,44,x', 'VNWRG,75,1,8,01'):
+        estimator.ser_port.write(estimator.write_full_vn_message(payload))
+    assert wait_until(lambda: sum(estimator.metrics.vnerr_codes.values()) == 5)
+    assert estimator.metrics.vnerr_codes == {5: 3, 7: 2}
+    assert emulator.registers[7] == ['40'] and emulator.registers[44] == ['0', '0', '5']
+    # and it is still answering
+    assert estimator.poll_response(estimator.read_register(7), 1.0) == ['40']
+
+def test_emulator_output_restarts_without_a_burst(emulator, estimator):
+    estimator.start_reading_threads()
+    assert wait_until(lambda: b'VNYMR' in estimator.ascii_samples)
+    assert estimator.poll_response(estimator.write_register(7, [0, 1]), 1.0) == ['0']
+    time.sleep(1.0)
+    before = estimator.ascii_samples[b'VNYMR'].count
+    assert estimator.poll_response(estimator.write_register(7, [40, 1]), 1.0) == ['40']
+    time.sleep(0.1)
+    # 40Hz for a tenth of a second, not the second it was off for as well
+    assert estimator.ascii_samples[b'VNYMR'].count - before <= 6
+
+def test_malformed_fields_are_counted():
+    estimator = HSIEstimator(port=None)
+    estimator.dispatch(b'VNYMR', b'abc' + b',1' * 11)
+    estimator.dispatch(b'VNRRG', b'')
+    estimator.dispatch(b'VNRRG', b'xx,1')
+    estimator.dispatch(b'VNERR', b'xx')
+    assert estimator.malformed_messages == 4
+    assert estimator.ascii_samples[b'VNYMR'].count == 0
+
+def test_mux_round_trip(emulator, tmp_path):
+    link = str(tmp_path / 'ttyVN100_host')
+    socket_path = str(tmp_path / 'vn100.sock')
+    mux = VNMux(emulator.path, 115200, [link], socket_path)
+    thread = threading.Thread(target=mux.run, daemon=True)
+    thread.start()
+    estimator = HSIEstimator(link)
+    estimator.response_timeout = 2.0
+    client = socket.socket(socket.AF_UNIX)
+    try:
+        estimator.start_reading_threads()
+        client.connect(socket_path)
+        client.settimeout(0.1)
+        # a good checksum with a bad register gets an error back, and everyone else carries on
+        client.send(estimator.write_full_vn_message('VNRRG,xx'))
+        client.send(estimator.write_full_vn_message('VNRRG'))
+        assert estimator.poll_response(estimator.read_register(1), 1.0) == ['VN-100T-CR']
+        assert estimator.poll_response(estimator.write_register(5, [921600]), 1.0) is None
+        data = b''
+        deadline = time.monotonic() + 1.0
+        while b'VNERR,05' not in data and time.monotonic() < deadline:
+            try:
+                data += client.recv(4096)
+            except socket.timeout:
+                pass
+        assert b'VNERR,07' in data and b'VNERR,05' in data
+        assert b'VNRRG,01' not in data
+        assert thread.is_alive()
+        assert wait_until(lambda: b'VNYMR' in estimator.ascii_samples)
+    finally:
+        client.close()
+        estimator.stop_reading_threads()
+        estimator.ser_port.close()
+        mux.active = False
+        thread.join(timeout=2.0)
+    assert not os.path.exists(link)
+
+def test_parser_process_round_trip(estimator):
+    estimator.start_parser_process()
+    estimator.start_reading_threads()
+    # the first command after starting used to lose its reply to the child opening the port
+    assert estimator.poll_response(estimator.write_register(7, [100, 1]), 1.0) == ['100']
+    assert estimator.poll_response(estimator.configure_binary_output({'common': ['time_startup', 'ypr']}, 8), 1.0)
+    assert wait_until(lambda: estimator.binary_samples and b'VNYMR' in estimator.ascii_samples)
+    samples = next(iter(estimator.binary_samples.values()))
+    assert wait_until(lambda: samples.count >= 10)
+    # host times come through the ring along with the samples
+    assert np.all(np.diff(samples.latest_host_ns(10)) > 0)
+    assert wait_until(lambda: estimator.parser_metrics is not None)
+    assert estimator.metrics_snapshot()['checksum_failures'] == 0
+    estimator.stop_reading_threads()
+    assert estimator.parser_process is None
+
+def test_session_log_round_trip(tmp_path):
+    path = str(tmp_path / 'session.vnrec')
+    with pytest.raises(ValueError):
+        SessionRecorder(path, SessionRecorder.MAX_INDEX_EVERY + 1)
+    open(path, 'wb').close()
+    with pytest.raises(ValueError, match='not a vn100 session log'):
+        SessionLog(path)
+    recorder = SessionRecorder(path, index_every=SessionRecorder.MAX_INDEX_EVERY)
+    frame = HSIEstimator(port=None).write_full_vn_message('VNRRG,01,VN-100T-CR')
+    for i in range(5000):
+        recorder.write(i, frame)
+    recorder.close()
+    log = SessionLog(path)
+    assert len(log.index) == 5000
+    assert sum(1 for _ in log.frames(start_ns=4000)) == 1000
+
+RING_LAYOUT = [('i', '<i8'), ('x', '<f8')]
+
+def test_replay(tmp_path):
+    path = str(tmp_path / 'session.vnrec')
+    ymr = vn_message('VNYMR' + ',+1.0' * 12)
+    reply = vn_message('VNRRG,01,VN-100T-CR')
+    recorder = SessionRecorder(path)
+    # two frames that came in the same read, then one from a read 200ms later
+    recorder.write(1_000_000_000, ymr)
+    recorder.write(1_000_000_000, binary_packet(YPR_HEADER, ypr_payload(7)))
+    recorder.write(1_200_000_000, ymr)
+    recorder.close()
+
+    estimator = HSIEstimator(port=None)
+    frames, seconds = estimator.replay(path, speed=None)
+    assert frames == 3 and estimator.checksum_failures == 0
+    samples = estimator.ascii_samples[b'VNYMR']
+    assert samples.count == 2 and samples.latest()['ypr'][0].tolist() == [1.0, 1.0, 1.0]
+    # same host times as live, including the earlier frame of a read arriving ahead of the bytes behind it
+    packet_bytes = len(binary_packet(YPR_HEADER, ypr_payload(7)))
+    assert samples.latest_host_ns().tolist() == [1_000_000_000 - int(packet_bytes * 1e10 / 115200), 1_200_000_000]
+    assert next(iter(estimator.binary_samples.values())).latest()['common_time_startup'].tolist() == [7]
+    # and at 2x speed the 200ms between reads takes 100ms
+    frames, seconds = HSIEstimator(port=None).replay(path, speed=2.0)
+    assert 0.09 < seconds < 0.2
+    # replies in a recording don't need anyone waiting for them
+    recorder = SessionRecorder(path)
+    recorder.write(0, reply)
+    recorder.close()
+    assert HSIEstimator(port=None).replay(path, speed=None)[0] == 1
+
+def publish_rows(ring: SharedSampleRing, first: int, n: int):
+    for i in range(first, first + n):
+        ring.publish(np.array([(i, i / 2)], dtype=RING_LAYOUT).view(np.uint8))
+
+# records views that let the writer publish n more rows right after the reader's copy, like a writer
+# lapping a reader that got descheduled in the middle of it
+class LappingRecords():
+    def __init__(self, records, writer: SharedSampleRing, n: int):
+        self.records = records
+        self.writer = writer
+        self.n = n
+
+    def __getitem__(self, slots):
+        copy = self.records[slots]
+        publish_rows(self.writer, int(self.writer.write_count[0]), self.n)
+        return copy
+
+@pytest.fixture
+def shared_ring(tmp_path):
+    writer = SharedSampleRing.create(str(tmp_path / 'ring'), RING_LAYOUT, 8)
+    reader = SharedSampleRing.open(writer.path)
+    yield writer, reader
+    writer.close()
+    reader.close()
+
+def test_shared_ring_latest(shared_ring):
+    writer, reader = shared_ring
+    assert len(reader.latest(4)) == 0
+    publish_rows(writer, 0, 5)
+    assert reader.latest(3)['i'].tolist() == [2, 3, 4]
+    # lapped: the slot the writer fills next is never handed out
+    publish_rows(writer, 5, 20)
+    assert reader.latest(100)['i'].tolist() == list(range(18, 25))
+    # a writer lapping the reader mid copy throws out whatever it may have overwritten
+    reader.records = LappingRecords(reader.records, writer, 5)
+    latest = reader.latest(6)
+    assert latest['i'].tolist() == [23, 24]
+    assert np.array_equal(latest['x'], latest['i'] / 2)
+
+def test_shared_ring_close_with_views_out(shared_ring):
+    writer, reader = shared_ring
+    publish_rows(writer, 0, 3)
+    records = reader.records
+    reader.close()
+    assert records['i'][:3].tolist() == [0, 1, 2]
+
+def test_shared_ring_read_since(shared_ring):
+    writer, reader = shared_ring
+    publish_rows(writer, 0, 3)
+    records, count, lost = reader.read_since(0)
+    assert records['i'].tolist() == [0, 1, 2] and count == 3 and lost == 0
+    assert len(reader.read_since(count)[0]) == 0
+    # lapped between reads, everything is either handed out or counted as lost
+    publish_rows(writer, 3, 20)
+    records, count, lost = reader.read_since(3)
+    assert records['i'].tolist() == list(range(16, 23)) and count == 23 and lost == 13
+    # and lapped in the middle of the copy
+    publish_rows(writer, 23, 4)
+    reader.records = LappingRecords(reader.records, writer, 5)
+    records, count, lost = reader.read_since(23)
+    assert records['i'].tolist() == [25, 26] and count == 27 and lost == 2
+
+def test_bench_compare():
+    baseline = [
+        {'name': 'parse', 'messages_per_s': 1000.0, 'p99_ns': 100.0, 'alloc_bytes_per_message': 100.0},
+        {'name': 'replay', 'messages_per_s': 1000.0, 'p99_ns': None, 'alloc_bytes_per_message': None},
+    ]
+    same = [dict(r) for r in baseline]
+    assert compare(same, baseline, 0.2) == []
+    worse = [dict(baseline[0], alloc_bytes_per_message=150.0), dict(baseline[1], p99_ns=500.0)]
+    regressions = compare(worse, baseline, 0.2)
+    assert len(regressions) == 1 and 'allocated' in regressions[0]
+
+def test_mux_client_never_tears_frames():
+    # a pty, like the robot's driver would have, takes part of a frame once its buffer is nearly full
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    os.set_blocking(slave, False)
+    client = MuxClient('slow', master)
+    frames = [vn_message(f'VNYMR,{i:+09.3f}' + ',+0.0' * 11) for i in range(1010)]
+    data = b''
+    try:
+        for frame in frames[:1000]:
+            client.send(frame)
+        assert client.dropped_bytes > 0 and client.pending
+        while True:
+            try:
+                data += os.read(slave, 65536)
+            except BlockingIOError:
+                break
+        # once the client has caught up the partly sent frame is finished before the next one
+        for frame in frames[1000:]:
+            client.send(frame)
+        data += os.read(slave, 65536)
+    finally:
+        os.close(master)
+        os.close(slave)
+    framer = VNFramer(len(data) + 1)
+    framer.feed(data)
+    received = sum(1 for _ in framer.frames())
+    assert framer.checksum_failures == 0 and framer.start == framer.end
+    assert received * len(frames[0]) + client.dropped_bytes == len(frames) * len(frames[0])
+
+def test_async_client(emulator):
+    async def run():
+        threads = threading.active_count()
+        vn = await AsyncVN100.open(emulator.link)
+        try:
+            # no threads of its own, the log included
+            assert threading.active_count() == threads
+            assert await vn.read_registers([1, 4]) == [['VN-100T-CR'], ['2.1.0.0']]
+            assert await vn.read_register(99, timeout=1.0) is None
+            assert await vn.write_register(7, [100, 1]) == ['100']
+            received = []
+            async for host_ns, sample in vn.samples(b'VNYMR'):
+                received.append(host_ns)
+                if len(received) == 5:
+                    break
+            assert received == sorted(received)
+        finally:
+            vn.close()
+    asyncio.run(asyncio.wait_for(run(), 5.0))
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_manager(emulators, processes):
+    devices = [(name, emulators(name).link, 115200) for name in ('a', 'b', 'c')]
+    manager = VNManager(devices, groups=2, processes=processes)
+    manager.start()
+    try:
+        assert manager.read_register('a', 1) == ['VN-100T-CR']
+        assert manager.send_commands('c', ['VNRRG,04', 'VNRRG,99']) == [['2.1.0.0'], None]
+        assert manager.configure_binary_output('b', {'common': ['time_startup', 'ypr']}, 8)
+        time.sleep(0.5)
+        snapshot = manager.metrics_snapshot()
+        assert sorted(snapshot['devices']) == ['a', 'b', 'c']
+        assert 'binary_010900' in snapshot['devices']['b']['frames_by_type']
+        total = snapshot['total']
+        for name in ('bytes_in', 'frames_in', 'commands_sent'):
+            assert total[name] == sum(device[name] for device in snapshot['devices'].values())
+        assert total['baudrate'] == 3 * 115200
+        assert total['command_rtt_ns']['count'] == 4
+    finally:
+        manager.stop()
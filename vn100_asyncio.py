@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import os
+import time
+import serial
+
+from VN100_HSIEstimator import BINARY_SYNC, HSIEstimator, SampleBuffer, VNError
+
+# asyncio version of the HSIEstimator serial path, so one event loop can drive several VN100s(and sockets)
+# without a reader thread per port. The framing, dispatch, sample buffers and command/reply matching are
+# the HSIEstimator's own, this only swaps the reader thread for a read pipe transport on the tty fd.
+# The estimator's log is drained on the loop too, so a port costs no threads at all.
+#   vn = await AsyncVN100.open('/dev/ttyAMA4')
+#   hsi = await vn.read_register(47)
+#   async for host_ns, sample in vn.samples(b'VNYMR'):
+#       ...
+
+class AsyncVN100(asyncio.Protocol):
+    def __init__(self, port: str, baudrate: int = 115200):
+        self.port = port
+        # decodes frames, keeps the sample buffers and matches replies to commands. It has no serial port of
+        # its own, commands go out through the write transport set as its ser_port in open()
+        self.estimator = HSIEstimator(port=None, baudrate=baudrate)
+        self.estimator.sample_listeners.append(self.notify)
+        self.ser_port = None
+        self.read_transport = None
+        self.write_transport = None
+        # queues of the running samples() iterators, by message type(b'binary' for the binary outputs)
+        self.subscribers = {}
+        # samples thrown away because an iterator wasn't keeping up
+        self.dropped_samples = 0
+        # resolves when the port goes away, to the exception if there was one
+        self.closed = None
+
+    # opens the port and starts reading it on the running loop
+    @classmethod
+    async def open(cls, port: str, baudrate: int = 115200) -> 'AsyncVN100':
+        vn = cls(port, baudrate)
+        loop = asyncio.get_running_loop()
+        vn.closed = loop.create_future()
+        # pyserial still does the tty setup(raw mode, baud, flow control), the loop does all the i/o
+        vn.ser_port = serial.Serial(port, baudrate, timeout=0, rtscts=True)
+        fd = vn.ser_port.fileno()
+        vn.read_transport, _ = await loop.connect_read_pipe(lambda: vn, open(os.dup(fd), 'rb', buffering=0))
+        vn.write_transport, _ = await loop.connect_write_pipe(asyncio.Protocol, open(os.dup(fd), 'wb', buffering=0))
+        vn.estimator.ser_port = vn.write_transport
+        return vn
+
+    def data_received(self, data: bytes):
+        t_ns = time.monotonic_ns()
+        framer = self.estimator.framer
+        # a read bigger than the framer's free space goes through in pieces
+        while data:
+            n = framer.feed(data)
+            self.estimator.process_frames(t_ns)
+            data = data[n:]
+        self.estimator.metrics.parse_ns.record(time.monotonic_ns() - t_ns)
+        self.estimator.log.drain()
+
+    def connection_lost(self, exc):
+        self.estimator.cancel_responses()
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    # sample listener, hands the newest sample to every iterator waiting on its type
+    def notify(self, msg_type: bytes, samples: SampleBuffer):
+        queues = self.subscribers.get(b'binary' if msg_type[0] == BINARY_SYNC else msg_type)
+        if not queues:
+            return
+        slot = (samples.count - 1) % samples.capacity
+        item = (int(samples.host_ns[slot]), samples.data[slot].copy())
+        for queue in queues:
+            if queue.full():
+                # drop the oldest rather than stall the read
+                queue.get_nowait()
+                self.dropped_samples += 1
+            queue.put_nowait(item)
+
+    # async iterator of (host_ns, sample) for every decoded msg_type sample(e.g. b'VNYMR', or b'binary')
+    # from now on. Up to maxsize samples wait for a slow consumer, after that the oldest are dropped
+    async def samples(self, msg_type: bytes, maxsize: int = 1024):
+        queue = asyncio.Queue(maxsize)
+        self.subscribers.setdefault(msg_type, []).append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.subscribers[msg_type].remove(queue)
+
+    # sends the commands in one write and waits for all the replies, None for any that timed out or failed
+    async def send_commands(self, payloads: list, timeout: float = None) -> list:
+        estimator = self.estimator
+        if timeout is None:
+            timeout = estimator.response_timeout
+        futures = estimator.send_commands(payloads)
+        results = []
+        for future in futures:
+            try:
+                results.append(await asyncio.wait_for(asyncio.wrap_future(future), timeout))
+            except asyncio.TimeoutError:
+                estimator.forget_response(future)
+                results.append(None)
+            except (ConnectionError, VNError) as e:
+                estimator.log.warning(f'Command failed on {self.port}: {e}')
+                results.append(None)
+        return results
+
+    async def send_command(self, payload: str, timeout: float = None):
+        return (await self.send_commands([payload], timeout))[0]
+
+    # register values as a list of strings, None if the vn100 didn't answer
+    async def read_register(self, reg_id: int, timeout: float = None):
+        return await self.send_command(f'VNRRG,{reg_id:02d}', timeout)
+
+    async def read_registers(self, reg_ids: list, timeout: float = None) -> list:
+        return await self.send_commands([f'VNRRG,{reg_id:02d}' for reg_id in reg_ids], timeout)
+
+    # the values echoed back by the vn100, None if it didn't answer
+    async def write_register(self, reg_id: int, values: list, timeout: float = None):
+        values = ','.join(str(v) for v in values)
+        return await self.send_command(f'VNWRG,{reg_id:02d},{values}', timeout)
+
+    def close(self):
+        if self.read_transport is not None:
+            self.read_transport.close()
+        if self.write_transport is not None:
+            self.write_transport.close()
+        self.estimator.cancel_responses()
+        self.estimator.log.drain()
+        self.estimator.log.report()
+        if self.ser_port is not None:
+            self.ser_port.close()
+
+# identifies every vn100 and counts its samples for a while, all from one event loop
+async def watch(ports: list, baudrate: int, msg_type: bytes, seconds: float):
+    sensors = await asyncio.gather(*(AsyncVN100.open(port, baudrate) for port in ports))
+    counts = dict.fromkeys(ports, 0)
+
+    async def count(vn):
+        async for _ in vn.samples(msg_type):
+            counts[vn.port] += 1
+
+    try:
+        for vn, (model, firmware) in zip(sensors, await asyncio.gather(*(vn.read_registers([1, 4]) for vn in sensors))):
+            print(f"{vn.port}: {model and model[0]} firmware {firmware and firmware[0]}")
+        counters = [asyncio.create_task(count(vn)) for vn in sensors]
+        await asyncio.sleep(seconds)
+        for task in counters:
+            task.cancel()
+        for vn in sensors:
+            print(f"{vn.port}: {counts[vn.port] / seconds:.1f} {msg_type.decode()} samples/s, "
+                  f"{vn.estimator.checksum_failures} checksum failures, {vn.dropped_samples} dropped")
+    finally:
+        for vn in sensors:
+            vn.close()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Watch one or more VN100s from a single asyncio event loop')
+    parser.add_argument('--port', action='append', default=[],
+                        help='serial port of a vn100. Can be repeated')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--type', default='VNYMR',
+                        help='message type to count, e.g. VNYMR, or binary')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args(args)
+
+    asyncio.run(watch(args.port or ['/dev/ttyAMA4'], args.baud, args.type.encode('ascii'), args.seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+import argparse
+import math
+import os
+import select
+import struct
+import time
+import tty
+from warnings import warn
+import numpy as np
+
+from VN100_HSIEstimator import (ASCII_OUTPUT_TYPES, BINARY_GROUPS, RecursiveHSIEstimator, VNFramer,
+                                binary_layout, split_fields, vn_crc16, vn_xor8)
+
+# Pretend VN100 on a pseudo-terminal, for running the HSI tools without hardware.
+# Answers VNRRG/VNWRG/VNWNV/VNRFS/VNRST like the real thing(checksums, VNERR codes), and streams
+# the async outputs set in registers 6/7 and 75-77 from a vehicle that slowly tumbles through every
+# orientation with a known hard/soft iron distortion on its magnetometer.
+# Output rates aren't limited by a baud rate, so it can also be used to load test the reader.
+
+# register values at power up, as they would be read back
+DEFAULT_REGISTERS = {
+    1: ['VN-100T-CR'],
+    3: ['0100012345'],
+    4: ['2.1.0.0'],
+    5: ['115200'],
+    6: ['14'],
+    7: ['40'],
+    23: ['1', '0', '0', '0', '1', '0', '0', '0', '1', '0', '0', '0'],
+    44: ['0', '0', '5'],
+    47: ['1', '0', '0', '0', '1', '0', '0', '0', '1', '0', '0', '0'],
+    75: ['0', '0', '00'],
+    76: ['0', '0', '00'],
+    77: ['0', '0', '00'],
+}
+
+# registers a VNWRG can't change
+READ_ONLY_REGISTERS = (1, 3, 4, 47)
+
+# the imu runs at 800Hz, binary outputs are that divided by their rate divisor
+IMU_RATE = 800
+
+# earth's field in NED, in gauss
+EARTH_FIELD = np.array([0.22, 0.02, 0.42])
+
+def vn_message(payload: str) -> bytes:
+    return f'${payload}*{vn_xor8(payload.encode("ascii")):02X}\r\n'.encode('ascii')
+
+def ypr_to_dcm(yaw: float, pitch: float, roll: float) -> np.ndarray:
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    cr, sr = math.cos(roll), math.sin(roll)
+    # body to NED
+    return np.array([
+        [cp * cy, sr * sp * cy - cr * sy, cr * sp * cy + sr * sy],
+        [cp * sy, sr * sp * sy + cr * cy, cr * sp * sy - sr * cy],
+        [-sp, sr * cp, cr * cp],
+    ])
+
+def dcm_to_quaternion(dcm: np.ndarray) -> np.ndarray:
+    # x, y, z, w like the vn100 reports it
+    w = math.sqrt(max(0.0, 1 + dcm[0, 0] + dcm[1, 1] + dcm[2, 2])) / 2
+    x = math.copysign(math.sqrt(max(0.0, 1 + dcm[0, 0] - dcm[1, 1] - dcm[2, 2])) / 2, dcm[2, 1] - dcm[1, 2])
+    y = math.copysign(math.sqrt(max(0.0, 1 - dcm[0, 0] + dcm[1, 1] - dcm[2, 2])) / 2, dcm[0, 2] - dcm[2, 0])
+    z = math.copysign(math.sqrt(max(0.0, 1 - dcm[0, 0] - dcm[1, 1] + dcm[2, 2])) / 2, dcm[1, 0] - dcm[0, 1])
+    return np.array([x, y, z, w])
+
+# the simulated vehicle and its sensors
+class VehicleModel():
+    def __init__(self, hard_iron, soft_iron, noise: float = 0.001, seed: int = 0):
+        self.hard_iron = np.asarray(hard_iron, dtype=float)
+        # soft iron distortion, raw = soft_iron @ field + hard_iron
+        self.soft_iron = np.asarray(soft_iron, dtype=float).reshape(3, 3)
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def attitude(self, t: float) -> tuple:
+        # slow tumble that ends up pointing every way
+        return (math.radians(35 * t) % (2 * math.pi) - math.pi,
+                math.radians(80 * math.sin(0.21 * t)),
+                math.radians(170 * math.sin(0.13 * t)))
+
+    # everything the outputs need at time t(seconds since start)
+    def sample(self, t: float) -> dict:
+        yaw, pitch, roll = self.attitude(t)
+        dcm = ypr_to_dcm(yaw, pitch, roll)
+        # body rates from how the attitude moves over a millisecond
+        dcm_next = ypr_to_dcm(*self.attitude(t + 1e-3))
+        skew = dcm.T @ (dcm_next - dcm) / 1e-3
+        gyro = np.array([skew[2, 1], skew[0, 2], skew[1, 0]])
+        field = dcm.T @ EARTH_FIELD
+        raw_mag = self.soft_iron @ field + self.hard_iron + self.rng.normal(scale=self.noise, size=3)
+        accel = dcm.T @ np.array([0.0, 0.0, -9.81]) + self.rng.normal(scale=0.01, size=3)
+        return {
+            'ypr': np.degrees([yaw, pitch, roll]),
+            'quaternion': dcm_to_quaternion(dcm),
+            'dcm': dcm.ravel(),
+            'mag': field,
+            'uncomp_mag': raw_mag,
+            'accel': accel,
+            'uncomp_accel': accel,
+            'gyro': gyro,
+            'uncomp_gyro': gyro,
+            'angular_rate': gyro,
+            'temp': 25.0,
+            'pres': 101.325,
+        }
+
+class VNEmulator():
+    def __init__(self, link: str = None, rate: float = None, hard_iron=(0.08, -0.15, 0.21),
+                 soft_iron=(1.05, 0.04, 0.0, 0.04, 0.93, 0.02, 0.0, 0.02, 1.02)):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+
+        self.registers = {reg: list(values) for reg, values in DEFAULT_REGISTERS.items()}
+        self.flash = {reg: list(values) for reg, values in DEFAULT_REGISTERS.items()}
+        # overrides register 7, and isn't capped at the rates the real one allows
+        self.rate = rate
+        self.model = VehicleModel(hard_iron, soft_iron)
+        self.hsi = None
+        self.framer = VNFramer(4096)
+        self.t_start = time.monotonic()
+        self.next_ascii = self.t_start
+        self.next_binary = {}
+        self.bytes_out = 0
+        self.messages_out = 0
+        self.active = False
+
+    # commands from the host
+    def handle(self, msg_type: bytes, body):
+        fields = [f.decode('ascii') for f in split_fields(body)]
+        if msg_type in (b'VNRRG', b'VNWRG'):
+            # not enough parameters, or an invalid one
+            if not fields or not fields[0]:
+                return self.error(5)
+            try:
+                reg = int(fields[0])
+            except ValueError:
+                return self.error(7)
+        if msg_type == b'VNRRG':
+            if reg not in self.registers:
+                return self.error(8)
+            return self.reply(f'VNRRG,{reg:02d},' + ','.join(self.registers[reg]))
+        if msg_type == b'VNWRG':
+            if reg not in self.registers:
+                return self.error(8)
+            if reg in READ_ONLY_REGISTERS:
+                return self.error(9)
+            code = self.check_values(reg, fields[1:])
+            if code is not None:
+                return self.error(code)
+            self.write_register(reg, fields[1:])
+            return self.reply(f'VNWRG,{reg:02d},' + ','.join(self.registers[reg]))
+        if msg_type == b'VNWNV':
+            self.flash = {reg: list(values) for reg, values in self.registers.items()}
+            return self.reply('VNWNV')
+        if msg_type == b'VNRFS':
+            self.flash = {reg: list(values) for reg, values in DEFAULT_REGISTERS.items()}
+            return self.reply('VNRFS')
+        if msg_type == b'VNRST':
+            self.registers = {reg: list(values) for reg, values in self.flash.items()}
+            self.hsi = None
+            return self.reply('VNRST')
+        return self.error(4)
+
+    # the VNERR code for values a VNWRG can't store in reg, None if they are fine
+    def check_values(self, reg: int, values: list):
+        if len(values) < len(DEFAULT_REGISTERS[reg]):
+            return 5
+        try:
+            if reg in (75, 76, 77):
+                # async mode, rate divisor, then the groups and a field mask for each, in hex
+                int(values[0]), int(values[1])
+                masks = [int(v, 16) for v in values[2:]]
+                if len(masks) < 1 + bin(masks[0]).count('1'):
+                    return 5
+            else:
+                parse = float if reg == 23 else int
+                for value in values:
+                    parse(value)
+        except ValueError:
+            return 7
+        return None
+
+    def write_register(self, reg: int, values: list):
+        # the optional serial port argument on 6/7 isn't stored
+        if reg in (6, 7):
+            values = values[:1]
+            # the ascii output starts over from now, rather than catching up on the slots it was off for
+            self.next_ascii = time.monotonic()
+        self.registers[reg] = values
+        if reg == 44:
+            # starting the hsi estimator begins a fresh fit, stopping it keeps the last estimate in 47
+            mode = int(values[0])
+            if mode == 1 and self.hsi is None:
+                self.hsi = RecursiveHSIEstimator()
+            elif mode == 0:
+                self.hsi = None
+        if reg in (75, 76, 77):
+            self.next_binary[reg] = time.monotonic()
+
+    def reply(self, payload: str):
+        self.send(vn_message(payload), 1)
+
+    def error(self, code: int):
+        self.send(vn_message(f'VNERR,{code:02d}'), 1)
+
+    def send(self, data: bytes, messages: int):
+        try:
+            os.write(self.master, data)
+            self.bytes_out += len(data)
+            self.messages_out += messages
+        except BlockingIOError:
+            # nobody is reading the pty, same as the uart's buffer overflowing
+            pass
+
+    def ascii_output(self, sample: dict) -> bytes:
+        output = next((t for t, v in ASCII_OUTPUT_TYPES.items() if v == int(self.registers[6][0])), None)
+        if output is None:
+            return b''
+        names = {
+            b'VNYMR': ('ypr', 'mag', 'accel', 'gyro'),
+            b'VNQMR': ('quaternion', 'mag', 'accel', 'gyro'),
+            b'VNMAR': ('mag', 'accel', 'gyro'),
+            b'VNIMU': ('uncomp_mag', 'uncomp_accel', 'uncomp_gyro', 'temp', 'pres'),
+            b'VNMAG': ('mag',),
+        }[output]
+        values = np.concatenate([np.atleast_1d(sample[name]) for name in names])
+        return vn_message(output.decode() + ',' + ','.join(f'{v:+.5f}' for v in values))
+
+    # header for a binary output register, or None if it is off
+    def binary_header(self, reg: int):
+        values = self.registers[reg]
+        if int(values[0]) == 0 or int(values[1]) == 0:
+            return None
+        groups = int(values[2], 16)
+        masks = [int(v, 16) for v in values[3:3 + bin(groups).count('1')]]
+        return bytes([0xFA, groups]) + struct.pack(f'<{len(masks)}H', *masks)
+
+    def binary_output(self, header: bytes, sample: dict, t_ns: int) -> bytes:
+        layout = binary_layout(header)
+        if layout is None:
+            return b''
+        packet = np.zeros(1, dtype=layout)
+        group_names = [g[0] for g in BINARY_GROUPS if g is not None]
+        for field in layout.names:
+            group = next(g for g in group_names if field.startswith(g + '_'))
+            name = field[len(group) + 1:]
+            if name == 'time_startup':
+                packet[field] = t_ns
+            elif name == 'imu':
+                packet[field] = np.concatenate((sample['uncomp_accel'], sample['uncomp_gyro']))
+            elif name == 'mag_pres':
+                packet[field] = np.concatenate((sample['mag'], [sample['temp'], sample['pres']]))
+            elif name in sample:
+                packet[field] = sample[name]
+        body = header[1:] + packet.tobytes()
+        return b'\xfa' + body + struct.pack('>H', vn_crc16(body))
+
+    # writes every output that is due by now
+    def stream(self, now: float):
+        sample = None
+        out = b''
+        messages = 0
+        rate = self.rate or float(self.registers[7][0])
+        if rate > 0 and now >= self.next_ascii:
+            while now >= self.next_ascii:
+                sample = self.model.sample(self.next_ascii - self.t_start)
+                self.feed_hsi(sample)
+                out += self.ascii_output(sample)
+                messages += 1
+                self.next_ascii += 1 / rate
+        for reg in (75, 76, 77):
+            header = self.binary_header(reg)
+            if header is None:
+                continue
+            period = int(self.registers[reg][1]) / IMU_RATE
+            while now >= self.next_binary.get(reg, now):
+                t = self.next_binary.get(reg, now)
+                sample = self.model.sample(t - self.t_start)
+                self.feed_hsi(sample)
+                out += self.binary_output(header, sample, int((t - self.t_start) * 1e9))
+                messages += 1
+                self.next_binary[reg] = t + period
+        if out:
+            self.send(out, messages)
+
+    def feed_hsi(self, sample: dict):
+        if self.hsi is None:
+            return
+        self.hsi.update(sample['uncomp_mag'])
+        if self.hsi.count % 20 == 0 and self.hsi.count >= 100:
+            try:
+                hsi = self.hsi.estimate()
+            except (ValueError, np.linalg.LinAlgError):
+                return
+            self.registers[47] = [f'{v:+.6f}' for v in hsi['C'] + hsi['B']]
+
+    # time until the next output is due
+    def next_due(self, now: float) -> float:
+        due = [self.next_ascii] if (self.rate or float(self.registers[7][0])) > 0 else []
+        due += [t for reg, t in self.next_binary.items() if self.binary_header(reg) is not None]
+        return max(0.0, min(due) - now) if due else 0.1
+
+    def run(self):
+        self.active = True
+        print(f'VN100 emulator on {self.link or self.path}')
+        try:
+            while self.active:
+                now = time.monotonic()
+                readable, _, _ = select.select([self.master], [], [], self.next_due(now))
+                if readable:
+                    try:
+                        data = os.read(self.master, 4096)
+                    except (BlockingIOError, OSError):
+                        data = b''
+                    self.framer.feed(data)
+                    failures = self.framer.checksum_failures
+                    for msg_type, body in self.framer.frames():
+                        try:
+                            self.handle(msg_type, body)
+                        except Exception as e:
+                            # a command we got wrong mustn't stop the output everyone else is reading
+                            warn(f'Emulator failed on {bytes(self.framer.raw_frame())!r}: {e!r}')
+                    if self.framer.checksum_failures != failures:
+                        self.error(3)
+                        self.framer.checksum_failures = failures
+                self.stream(time.monotonic())
+        except KeyboardInterrupt:
+            print('Stopping the emulator...')
+        finally:
+            self.close()
+
+    def close(self):
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Emulated VN100 on a pseudo-terminal')
+    parser.add_argument('--link', default='/tmp/ttyVN100',
+                        help='symlink to create for the pty, use it as --port for the other tools')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='ascii async output rate in Hz, overrides register 7 and can go past real baud limits')
+    parser.add_argument('--hard-iron', type=float, nargs=3, default=(0.08, -0.15, 0.21),
+                        help='simulated hard iron offset, in gauss')
+    args = parser.parse_args(args)
+
+    emulator = VNEmulator(args.link, args.rate, args.hard_iron)
+    emulator.run()
+    if emulator.bytes_out:
+        print(f'Sent {emulator.messages_out} messages, {emulator.bytes_out} bytes')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+import argparse
+import itertools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from warnings import warn
+
+from VN100_HSIEstimator import HSIEstimator, LatencyHistogram, MetricsFile, PortWaiter
+
+# Drives several VN100 ports at once: several sensors on a test bench, or both UARTs of one VN100
+# (e.g. commands on one and a high rate binary stream on the other).
+# Every port gets its own HSIEstimator, so its own framer, dispatch and sample buffers. The ports are spread
+# over a few reader threads, or over child processes when parsing should get away from the GIL.
+# Work on the devices(commands, calibration, metrics) goes through the same ops either way, see device_op.
+
+# a device is (name, port, baudrate)
+def parse_device(text: str) -> tuple:
+    name, _, port = text.partition('=')
+    port, _, baud = port.partition(':')
+    return name, port, int(baud) if baud else 115200
+
+# Serves the reads of a group of devices from one thread, waiting on all their fds at once
+class ReaderWorker():
+    def __init__(self, devices: list):
+        self.devices = devices
+        self.waiter = PortWaiter()
+        for device in devices:
+            self.waiter.add(device.ser_port.fileno(), device)
+        self.active = False
+        self.thread = None
+
+    def start(self):
+        self.active = True
+        for device in self.devices:
+            device.tune_tty()
+            device.log.start()
+            device.check_tty_errors(device.ser_port.fileno())
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        flush_interval = min(device.read_flush_interval for device in self.devices)
+        while self.active:
+            ready = self.waiter.wait(flush_interval)
+            # everyone gets read after a timeout, in case fewer than read_min_bytes are sitting there
+            for device in ready or self.devices:
+                try:
+                    device.read_available(device.ser_port.fileno())
+                except Exception as e:
+                    device.log.error(f'Error in {device.name}: {e}')
+
+    def stop(self):
+        self.active = False
+        self.waiter.wake()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=2.0)
+        self.waiter.close()
+        for device in self.devices:
+            device.log.stop()
+            device.cancel_responses()
+            device.ser_port.close()
+
+# runs one op on a device and returns something picklable, so it works the same in a child process
+def device_op(device: HSIEstimator, op: str, args: tuple):
+    if op == 'commands':
+        # replies to a batch of commands, None for any that timed out or failed
+        payloads, timeout = args
+        futures = device.send_commands(payloads)
+        deadline = time.monotonic() + timeout
+        return [device.poll_response(f, max(0.0, deadline - time.monotonic())) for f in futures]
+    if op == 'binary_output':
+        groups, rate_divisor, output, async_mode = args
+        return device.poll_response(device.configure_binary_output(groups, rate_divisor, output, async_mode), 1.0)
+    if op == 'calibrate':
+        # unattended calibration, save decides whether the result is written to flash
+        convergence_rate, save = args
+        device.convergence_rate = convergence_rate
+        device.confirm_estimation = True
+        device.confirm_save = save
+        device.run_hsi_calibration()
+        return {'before': device.hsi_before, 'after': device.hsi_after}
+    if op == 'metrics':
+        return device.metrics_snapshot()
+    raise ValueError(f'Unknown device op {op}')
+
+# A group of devices in this process, ops run on a thread pool so a calibration doesn't hold up the rest
+class ThreadGroup():
+    def __init__(self, specs: list):
+        self.devices = {name: HSIEstimator(port, baud, name) for name, port, baud in specs}
+        self.worker = ReaderWorker(list(self.devices.values()))
+        self.pool = ThreadPoolExecutor(max_workers=len(specs) + 1)
+
+    def start(self):
+        self.worker.start()
+
+    def call(self, name: str, op: str, *args) -> Future:
+        return self.pool.submit(device_op, self.devices[name], op, args)
+
+    def stop(self):
+        self.worker.stop()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+# child process side of a ProcessGroup: owns the ports, answers (id, name, op, args) requests
+def group_process(conn, specs: list):
+    group = ThreadGroup(specs)
+    group.start()
+    send_lock = threading.Lock()
+
+    def reply(request_id, future):
+        try:
+            result = (True, future.result())
+        except Exception as e:
+            result = (False, repr(e))
+        with send_lock:
+            conn.send((request_id, *result))
+
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            request_id, name, op, args = request
+            group.call(name, op, *args).add_done_callback(lambda f, i=request_id: reply(i, f))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        group.stop()
+
+# A group of devices in a child process, with its own interpreter and GIL
+# Requests go down a pipe, and a thread here completes the matching future when the reply comes back
+class ProcessGroup():
+    def __init__(self, specs: list):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=group_process, args=(child_conn, specs), daemon=True)
+        self.pending = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.process.start()
+        self.thread = threading.Thread(target=self.replies, daemon=True)
+        self.thread.start()
+
+    def replies(self):
+        try:
+            while True:
+                request_id, ok, result = self.conn.recv()
+                with self.lock:
+                    future = self.pending.pop(request_id)
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(result))
+        except (EOFError, OSError):
+            # the child is gone, nothing else is coming back
+            with self.lock:
+                waiting, self.pending = list(self.pending.values()), {}
+            for future in waiting:
+                future.set_exception(ConnectionError('Device process exited'))
+
+    def call(self, name: str, op: str, *args) -> Future:
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            self.conn.send((request_id, name, op, args))
+        return future
+
+    def stop(self):
+        try:
+            with self.lock:
+                self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=3.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+# adds up the metrics of several devices into one snapshot of the same shape
+def merge_snapshots(snapshots: list) -> dict:
+    total = {
+        'uptime_s': max((s['uptime_s'] for s in snapshots), default=0.0),
+        # total link capacity, so link_utilization is over all the ports
+        'baudrate': sum(s['baudrate'] or 0 for s in snapshots) or None,
+        'frames_by_type': {},
+        'vnerr_codes': {},
+        'tty_errors': None,
+        'sensor_clock_offset_ns': None,
+        'sensor_clock_drift_ppm': None,
+    }
+    for name in ('bytes_in', 'bytes_out', 'frames_in', 'checksum_failures', 'malformed_messages',
+                 'commands_sent', 'commands_timed_out', 'log_dropped'):
+        total[name] = sum(s[name] for s in snapshots)
+    for snapshot in snapshots:
+        for key in ('frames_by_type', 'vnerr_codes'):
+            for kind, n in snapshot[key].items():
+                total[key][kind] = total[key].get(kind, 0) + n
+        if snapshot['tty_errors'] is not None:
+            total['tty_errors'] = total['tty_errors'] or {}
+            for kind, n in snapshot['tty_errors'].items():
+                total['tty_errors'][kind] = total['tty_errors'].get(kind, 0) + n
+    for name in ('parse_ns', 'command_rtt_ns'):
+        histogram = LatencyHistogram()
+        for snapshot in snapshots:
+            h = snapshot[name]
+            histogram.buckets = [a + b for a, b in zip(histogram.buckets, h['buckets'])]
+            histogram.count += h['count']
+            histogram.total_ns += h['total_ns']
+            histogram.max_ns = max(histogram.max_ns, h['max_ns'])
+        total[name] = histogram.snapshot()
+    return total
+
+class VNManager():
+    # devices is a list of (name, port, baudrate), spread round robin over groups reader threads(or processes)
+    def __init__(self, devices: list, groups: int = 1, processes: bool = False):
+        groups = max(1, min(groups, len(devices)))
+        specs = [devices[i::groups] for i in range(groups)]
+        group_type = ProcessGroup if processes else ThreadGroup
+        self.groups = [group_type(spec) for spec in specs]
+        self.group_of = {name: group for group, spec in zip(self.groups, specs) for name, _, _ in spec}
+        self.metrics_file = None
+
+    @property
+    def names(self) -> list:
+        return list(self.group_of)
+
+    def start(self):
+        for group in self.groups:
+            group.start()
+
+    def stop(self):
+        if self.metrics_file is not None:
+            self.metrics_file.stop()
+            self.metrics_file = None
+        for group in self.groups:
+            group.stop()
+
+    def call(self, name: str, op: str, *args) -> Future:
+        return self.group_of[name].call(name, op, *args)
+
+    # runs op on every device(or just names) at once, returns {name: result}, None where it failed
+    def call_all(self, op: str, *args, names=None, timeout: float = None) -> dict:
+        futures = {name: self.call(name, op, *args) for name in names or self.names}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout)
+            except Exception as e:
+                warn(f'{op} failed on {name}: {e}')
+                results[name] = None
+        return results
+
+    # replies to a batch of commands on one device, None for any that didn't come back
+    def send_commands(self, name: str, payloads: list, timeout: float = 1.0) -> list:
+        return self.call(name, 'commands', payloads, timeout).result()
+
+    def read_register(self, name: str, reg_id: int, timeout: float = 1.0):
+        return self.send_commands(name, [f'VNRRG,{reg_id:02d}'], timeout)[0]
+
+    def configure_binary_output(self, name: str, groups: dict, rate_divisor: int = 1, output: int = 1, async_mode: int = 1):
+        return self.call(name, 'binary_output', groups, rate_divisor, output, async_mode).result()
+
+    # runs the hsi calibration on every device at once without prompts, {name: {'before': hsi, 'after': hsi}}
+    def calibrate_all(self, convergence_rate: int = 3, save: bool = False) -> dict:
+        return self.call_all('calibrate', convergence_rate, save)
+
+    # {'devices': {name: snapshot}, 'total': everything added up}, see HSIEstimator.metrics_snapshot
+    def metrics_snapshot(self) -> dict:
+        devices = {name: s for name, s in self.call_all('metrics', timeout=5.0).items() if s is not None}
+        return {'devices': devices, 'total': merge_snapshots(list(devices.values()))}
+
+    # keeps the totals over every device in path in prometheus text format
+    def start_metrics_file(self, path: str, interval: float = 5.0):
+        self.metrics_file = MetricsFile(lambda: self.metrics_snapshot()['total'], path, interval)
+        self.metrics_file.start()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run several VN100 ports at once')
+    parser.add_argument('--device', action='append', default=[],
+                        help='name=port[:baud], e.g. bench1=/dev/ttyUSB0:115200. Can be repeated')
+    parser.add_argument('--groups', type=int, default=1,
+                        help='reader threads(or processes) to spread the ports over')
+    parser.add_argument('--processes', action='store_true',
+                        help='read each group of ports in its own process instead of a thread')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='run the hsi calibration on every device at once, without prompts')
+    parser.add_argument('--convergence', type=int, default=3,
+                        help='hsi convergence rate(1-5) for --calibrate')
+    parser.add_argument('--save', action='store_true',
+                        help='write the calibration to flash on every device')
+    parser.add_argument('--seconds', type=float, default=10.0,
+                        help='how long to watch the devices for when not calibrating')
+    parser.add_argument('--metrics-file', default=None,
+                        help='keep the total metrics over all devices in this file in prometheus text format')
+    args = parser.parse_args(args)
+
+    if not args.device:
+        parser.error('give at least one --device')
+
+    manager = VNManager([parse_device(d) for d in args.device], args.groups, args.processes)
+    manager.start()
+    try:
+        if args.metrics_file:
+            manager.start_metrics_file(args.metrics_file)
+        if args.calibrate:
+            for name, result in manager.calibrate_all(args.convergence, args.save).items():
+                print(f"{name}: {result['after'] if result else 'failed'}")
+        else:
+            time.sleep(args.seconds)
+        for name, snapshot in manager.metrics_snapshot()['devices'].items():
+            print(f"{name}: {snapshot['bytes_in']} bytes, {snapshot['frames_in']} frames, "
+                  f"{snapshot['checksum_failures']} checksum failures, frames by type {snapshot['frames_by_type']}")
+    except KeyboardInterrupt:
+        print('Stopping...')
+    finally:
+        manager.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+import argparse
+import os
+import selectors
+import socket
+import time
+import tty
+import serial
+from warnings import warn
+
+from VN100_HSIEstimator import VN_COMMAND_ERRORS, VNFramer, split_fields, vn_xor8
+
+# Host side daemon that owns the VN100 serial port and shares it between several programs,
+# e.g. the HSI calibration on the host and the robot's driver in the bubble_blue container.
+# Clients either open a pty the daemon creates (looks like a normal serial port to them) or connect
+# to a unix socket. Every frame from the vn100 goes out to all clients, except command replies,
+# which only go back to the client that sent the command.
+# Register writes are passed on as they are, apart from the baud rate. The output registers are shared by
+# everyone though: running the HSI calibration through the mux turns the async output off, switches it to
+# VNIMU and leaves it at 40Hz VNYMR, so every other client(e.g. the robot's driver) loses or sees a changed
+# stream until it's done. The mux prints who wrote them, see OUTPUT_REGISTERS.
+
+# async output type(6), rate(7) and the binary outputs(75-77)
+OUTPUT_REGISTERS = (6, 7, 75, 76, 77)
+
+# a VNERR frame for code, what a client gets back for a command the mux won't pass on
+def error_reply(code: int) -> bytes:
+    payload = f'VNERR,{code:02d}'.encode('ascii')
+    return b'$' + payload + f'*{vn_xor8(payload):02X}\r\n'.encode('ascii')
+
+UNAUTHORIZED_REPLY = error_reply(9)
+
+# commands and the reply they get back, e.g. ('VNRRG', 47)
+# raises IndexError when the register is missing and ValueError when it isn't a number
+def command_key(msg_type: bytes, body) -> tuple:
+    if msg_type in (b'VNRRG', b'VNWRG'):
+        fields = split_fields(body)
+        if not fields or not fields[0]:
+            raise IndexError(f'{msg_type.decode()} without a register')
+        return msg_type, int(fields[0])
+    return msg_type, None
+
+class MuxClient():
+    def __init__(self, name: str, fd: int, sock=None):
+        self.name = name
+        self.fd = fd
+        self.sock = sock
+        # frames the commands the client sends us
+        self.framer = VNFramer(4096)
+        self.dropped_bytes = 0
+        # the rest of a frame a short write only got partly out
+        self.pending = b''
+
+    # sends one whole frame or none of it. A client that isn't keeping up has frames dropped rather than
+    # stalling everyone else, but a frame that went out in part is finished(on the next send) before anything
+    # new goes, so the client never sees a torn one
+    def send(self, data):
+        if self.pending:
+            self.pending = self.pending[self.write(self.pending):]
+            if self.pending:
+                self.dropped_bytes += len(data)
+                return
+        n = self.write(data)
+        if n == 0:
+            self.dropped_bytes += len(data)
+        else:
+            self.pending = data[n:]
+
+    # bytes written, 0 if the client's buffer is full
+    def write(self, data) -> int:
+        try:
+            if self.sock is not None:
+                return self.sock.send(data)
+            return os.write(self.fd, data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+class PtyClient(MuxClient):
+    def __init__(self, link: str):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        # we hold the slave open too, so the master doesn't error out while nobody has the pty open
+        self.slave = slave
+        if os.path.islink(link):
+            os.unlink(link)
+        os.symlink(os.ttyname(slave), link)
+        self.link = link
+        super().__init__(f'pty {link}', master)
+
+    def close(self):
+        if os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.fd)
+        os.close(self.slave)
+
+class VNMux():
+    def __init__(self, port: str, baudrate: int, ptys: list, socket_path: str = None,
+                 max_in_flight: int = 8, command_timeout: float = 1.0):
+        self.ser_port = serial.Serial(port, baudrate, timeout=0, rtscts=True)
+        self.framer = VNFramer()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.ser_port.fileno(), selectors.EVENT_READ, self.read_device)
+
+        self.clients = []
+        for link in ptys:
+            self.add_client(PtyClient(link))
+
+        self.server = None
+        self.socket_path = socket_path
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(socket_path)
+            self.server.listen()
+            self.server.setblocking(False)
+            self.selector.register(self.server, selectors.EVENT_READ, self.accept)
+
+        # command arbitration: at most max_in_flight commands on the wire, the rest wait their turn
+        self.max_in_flight = max_in_flight
+        self.command_timeout = command_timeout
+        self.queued = [] # (client, key, frame bytes)
+        self.in_flight = [] # (client, key, time sent)
+        self.active = False
+
+    def add_client(self, client: MuxClient):
+        self.clients.append(client)
+        self.selector.register(client.fd, selectors.EVENT_READ, lambda c=client: self.read_client(c))
+        print(f'Client connected: {client.name}')
+
+    def remove_client(self, client: MuxClient):
+        self.selector.unregister(client.fd)
+        self.clients.remove(client)
+        self.queued = [q for q in self.queued if q[0] is not client]
+        self.in_flight = [f if f[0] is not client else (None, f[1], f[2]) for f in self.in_flight]
+        if client.sock is not None:
+            client.sock.close()
+        print(f'Client disconnected: {client.name}')
+
+    def accept(self):
+        sock, _ = self.server.accept()
+        sock.setblocking(False)
+        self.add_client(MuxClient(f'socket {sock.fileno()}', sock.fileno(), sock))
+
+    # frames from the vn100, replies go to whoever asked, the rest to everyone
+    def read_device(self):
+        if not self.framer.read_fd(self.ser_port.fileno()):
+            return
+        for msg_type, body in self.framer.frames():
+            frame = bytes(self.framer.raw_frame())
+            command = self.retire_command(msg_type, body)
+            if command is None:
+                for client in self.clients:
+                    client.send(frame)
+            elif command[0] is not None:
+                # a client that left still has its reply swallowed rather than broadcast
+                command[0].send(frame)
+        self.send_queued()
+
+    # finds and removes the in-flight command this frame answers, None if it isn't a reply
+    def retire_command(self, msg_type: bytes, body):
+        try:
+            if msg_type == b'VNERR':
+                if not self.in_flight or int(body) not in VN_COMMAND_ERRORS:
+                    return None
+                return self.in_flight.pop(0)
+            if msg_type not in (b'VNRRG', b'VNWRG', b'VNWNV', b'VNRFS', b'VNRST'):
+                return None
+            key = command_key(msg_type, body)
+        except (IndexError, ValueError):
+            # not a reply we can match, everyone gets it
+            return None
+        for i, command in enumerate(self.in_flight):
+            if command[1] == key:
+                return self.in_flight.pop(i)
+        return None
+
+    def read_client(self, client: MuxClient):
+        try:
+            data = client.sock.recv(4096) if client.sock is not None else os.read(client.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            if client.sock is not None:
+                self.remove_client(client)
+            return
+        client.framer.feed(data)
+        for msg_type, body in client.framer.frames():
+            try:
+                key = command_key(msg_type, body)
+            except IndexError:
+                # not enough parameters
+                client.send(error_reply(5))
+                continue
+            except ValueError:
+                # invalid parameter
+                client.send(error_reply(7))
+                continue
+            if msg_type == b'VNWRG' and key[1] == 5:
+                # the mux owns the link, a baud change would cut everyone off
+                client.send(UNAUTHORIZED_REPLY)
+                continue
+            if msg_type == b'VNWRG' and key[1] in OUTPUT_REGISTERS:
+                print(f'{client.name} is changing the output of every client(register {key[1]})')
+            self.queued.append((client, key, bytes(client.framer.raw_frame())))
+        self.send_queued()
+
+    def send_queued(self):
+        now = time.monotonic()
+        # forget commands the vn100 never answered
+        self.in_flight = [f for f in self.in_flight if now - f[2] < self.command_timeout]
+        out = b''
+        while self.queued and len(self.in_flight) < self.max_in_flight:
+            client, key, frame = self.queued.pop(0)
+            self.in_flight.append((client, key, now))
+            out += frame
+        if out:
+            self.ser_port.write(out)
+
+    def run(self):
+        self.active = True
+        print(f'VN100 mux running on {self.ser_port.port}')
+        try:
+            while self.active:
+                for key, _ in self.selector.select(timeout=self.command_timeout):
+                    try:
+                        key.data()
+                    except Exception as e:
+                        # one bad client(or read) mustn't take the port away from everyone else
+                        warn(f'Error in the mux: {e!r}')
+                if self.queued:
+                    self.send_queued()
+        except KeyboardInterrupt:
+            print('Stopping the mux...')
+        finally:
+            self.close()
+
+    def close(self):
+        for client in list(self.clients):
+            if isinstance(client, PtyClient):
+                client.close()
+            elif client.sock is not None:
+                client.sock.close()
+        if self.server is not None:
+            self.server.close()
+            os.unlink(self.socket_path)
+        self.ser_port.close()
+        if self.framer.checksum_failures:
+            warn(f'{self.framer.checksum_failures} frames from the vn100 failed their checksum')
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Share the VN100 serial port between several programs')
+    parser.add_argument('--port', default='/dev/ttyAMA4')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--pty', action='append', default=[],
+                        help='path of a pty symlink to create for a client, e.g. /dev/ttyVN100_robot. Can be repeated')
+    parser.add_argument('--socket', default=None,
+                        help='path of a unix socket clients can connect to')
+    args = parser.parse_args(args)
+
+    if not args.pty and not args.socket:
+        parser.error('give at least one --pty or --socket for clients to connect to')
+
+    mux = VNMux(args.port, args.baud, args.pty, args.socket)
+    mux.run()
+
+if __name__ == '__main__':
+    main()